@@ -62,6 +62,8 @@ GRPC_SERVER_PROCESS = None
 
 global SUPPORTED_SAMPLERS_LIST
 SUPPORTED_SAMPLERS_LIST = list(grpc_client.algorithms.keys())
+global SUPPORTED_SIGMA_SCHEDULES_LIST
+SUPPORTED_SIGMA_SCHEDULES_LIST = list(grpc_client.sigma_schedules.keys())
 #SUPPORTED_SAMPLERS_LIST = ["ddim", "k_euler", "k_euler_ancestral", "k_lms"]
 
 def run_string(run_string, cwd=".", log_path=None, err_path=None):  # run shell command asynchronously, return subprocess
@@ -212,6 +214,13 @@ def strip_args(args, level=0): # remove args we wouldn't want to print or serial
 
         if "noise_end" in args_stripped: del args_stripped.noise_end
         if "noise_eta" in args_stripped: del args_stripped.noise_start
+
+        if "guidance_cutoff" in args_stripped:
+            if args_stripped.guidance_cutoff >= 1.: del args_stripped.guidance_cutoff
+        if "guidance_cutoff_delta" in args_stripped:
+            if args_stripped.guidance_cutoff_delta <= 0.: del args_stripped.guidance_cutoff_delta
+        if "tile_size" in args_stripped:
+            if args_stripped.tile_size <= 0: del args_stripped.tile_size
         if "init_img" in args_stripped:
             if args_stripped.init_img == "": # if there was no input image these fields are not relevant
                 del args_stripped.init_img
@@ -345,6 +354,10 @@ def get_samples(args, write=True):
     assert((args.n > 0) or write) # repeating forever without writing to disk wouldn't make much sense
     init_image, mask_image = build_sample_args(args)
 
+    # a list of scales is a guidance scale sweep, each seed comes back once per scale and they're all sampled in one batch
+    if isinstance(args.scale, (list, tuple)): scales = list(args.scale)
+    else: scales = None
+
     samples = []
     stability_api = grpc_client.StabilityInference("localhost:50051", None, engine=args.model_name, verbose=False)
     while True: # watch out! a wild shrew!
@@ -354,18 +367,23 @@ def get_samples(args, write=True):
             grpc_samples = grpc_client.process_artifacts_from_answers("", answers, write=False, verbose=False)
 
             start_time = datetime.datetime.now(); args.start_time = str(start_time)
-            for path, artifact in grpc_samples:
+            for artifact_num, (path, artifact) in enumerate(grpc_samples):
                 end_time = datetime.datetime.now(); args.end_time = str(end_time); args.elapsed_time = str(end_time-start_time)
                 args.status = 2; args.err_txt = "" # completed successfully
 
                 image = cv2.imdecode(np.fromstring(artifact.binary, dtype="uint8"), cv2.IMREAD_UNCHANGED)
-                if "annotation" in args: image = get_annotated_image(image, args)
+                if scales: sample_args = argparse.Namespace(**vars(args)); sample_args.scale = round(artifact.cfg_scale, 4); sample_args.final_output_name += "_cfg" + str(sample_args.scale)
+                else: sample_args = args
+                if "annotation" in args: image = get_annotated_image(image, sample_args)
                 samples.append(image)
 
                 if write:
                     args.uuid_str = get_random_string(digits=16) # new uuid for new sample
-                    save_sample(image, args)
+                    sample_args.uuid_str = args.uuid_str
+                    save_sample(image, sample_args)
+                    if scales: args.output_file = sample_args.output_file
 
+                if scales and ((artifact_num+1) % len(scales)) != 0: continue # same seed, next scale
                 if args.seed: args.seed += 1 # increment seed or random seed if none was given as we go through the batch
                 else: args.auto_seed += 1
                 if (len(samples) < args.n) or (args.n <= 0): # reset start time for next sample if we still have samples left
@@ -460,8 +478,14 @@ def get_args_parser():
         "--sampler",
         type=str,
         default="k_euler",
-        help="sampler to use (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms)"
+        help="sampler to use (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms, k_dpmpp_2m, unipc)"
     )  
+    parser.add_argument(
+        "--sigma_schedule",
+        type=str,
+        default=DEFAULT_SAMPLE_SETTINGS.sigma_schedule,
+        help="noise level spacing for the k_* and unipc samplers (default, karras, exponential). karras usually needs fewer steps",
+    )
     parser.add_argument(
         "--command",
         type=str,
@@ -486,6 +510,24 @@ def get_args_parser():
         default=DEFAULT_SAMPLE_SETTINGS.scale,
         help="classifier-free guidance scale (~amount of change per step)",
     )
+    parser.add_argument(
+        "--guidance_cutoff",
+        type=float,
+        default=DEFAULT_SAMPLE_SETTINGS.guidance_cutoff,
+        help="stop classifier-free guidance after this fraction of the steps, ~0.7 saves about 15%% of the sampling time. 1 guides every step",
+    )
+    parser.add_argument(
+        "--guidance_cutoff_delta",
+        type=float,
+        default=DEFAULT_SAMPLE_SETTINGS.guidance_cutoff_delta,
+        help="stop classifier-free guidance once the difference between the conditional and unconditional predictions is below this (0 to disable)",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=DEFAULT_SAMPLE_SETTINGS.tile_size,
+        help="denoise images wider or taller than this many pixels as overlapping tiles of this size, to keep detail at large resolutions (0 to disable)",
+    )
     parser.add_argument(
         "--noise_q",
         type=float,
@@ -608,6 +650,10 @@ def build_grpc_request_dict(args, init_image, mask_image):
         "cfg_scale": args.scale,
         "eta": args.noise_eta,
         "sampler": grpc_client.get_sampler_from_str(args.sampler),
+        "sigma_schedule": grpc_client.get_sigma_schedule_from_str(args.sigma_schedule),
+        "guidance_cutoff": args.guidance_cutoff if args.guidance_cutoff < 1. else None,
+        "guidance_cutoff_delta": args.guidance_cutoff_delta if args.guidance_cutoff_delta > 0. else None,
+        "tile_size": args.tile_size if args.tile_size > 0 else None,
         "steps": args.steps,
         "seed": seed,
         "samples": n,
@@ -47,6 +47,14 @@ algorithms: Dict[str, int] = {
     "k_dpm_2": generation.SAMPLER_K_DPM_2,
     "k_dpm_2_ancestral": generation.SAMPLER_K_DPM_2_ANCESTRAL,
     "k_lms": generation.SAMPLER_K_LMS,
+    "k_dpmpp_2m": generation.SAMPLER_K_DPMPP_2M,
+    "unipc": generation.SAMPLER_UNIPC,
+}
+
+sigma_schedules: Dict[str, int] = {
+    "default": generation.SIGMA_SCHEDULE_DEFAULT,
+    "karras": generation.SIGMA_SCHEDULE_KARRAS,
+    "exponential": generation.SIGMA_SCHEDULE_EXPONENTIAL,
 }
 
 def image_to_prompt(im, init: bool = False, mask: bool = False) -> Tuple[str, generation.Prompt]:
@@ -85,6 +93,18 @@ def get_sampler_from_str(s: str) -> generation.DiffusionSampler:
         raise ValueError(f"unknown sampler {s}")
     return algorithm
 
+def get_sigma_schedule_from_str(s: str) -> generation.SigmaSchedule:
+    """
+    Convert a string to a SigmaSchedule enum.
+
+    :param s: The string to convert.
+    :return: The SigmaSchedule enum.
+    """
+    schedule = sigma_schedules.get(s.lower().strip(), None)
+    if schedule is None:
+        raise ValueError(f"unknown sigma schedule {s}")
+    return schedule
+
 
 def process_artifacts_from_answers(
     prefix: str,
@@ -216,9 +236,13 @@ class StabilityInference:
         width: int = 512,
         start_schedule: float = 1.0,
         end_schedule: float = 0.01,
-        cfg_scale: float = 7.0,
+        cfg_scale: Union[float, Sequence[float]] = 7.0,
         eta: float = 0.0,
         sampler: generation.DiffusionSampler = generation.SAMPLER_K_LMS,
+        sigma_schedule: generation.SigmaSchedule = generation.SIGMA_SCHEDULE_DEFAULT,
+        guidance_cutoff: float = None,
+        guidance_cutoff_delta: float = None,
+        tile_size: int = None,
         steps: int = 50,
         seed: Union[Sequence[int], int] = 0,
         samples: int = 1,
@@ -228,15 +252,21 @@ class StabilityInference:
         """
         Generate images from a prompt.
 
-        :param prompt: Prompt to generate images from.
+        :param prompt: Prompt to generate images from. A list of prompts is generated as a single batch, with
+            each artifact's prompt_index saying which prompt it came from.
         :param init_image: Init image.
         :param mask_image: Mask image
         :param height: Height of the generated images.
         :param width: Width of the generated images.
         :param start_schedule: Start schedule for init image.
         :param end_schedule: End schedule for init image.
-        :param cfg_scale: Scale of the configuration.
+        :param cfg_scale: Scale of the configuration. A list of scales sweeps over them, generating each sample
+            once per scale in a single batch.
         :param sampler: Sampler to use.
+        :param sigma_schedule: How to space the sampler's noise levels (K-diffusion samplers only).
+        :param guidance_cutoff: Fraction of the steps after which to stop running the unconditional pass.
+        :param guidance_cutoff_delta: Stop running the unconditional pass once the cond/uncond difference is below this.
+        :param tile_size: Denoise images larger than this (in pixels) as overlapping tiles of this size.
         :param steps: Number of steps to take.
         :param seed: Seed for the random number generator.
         :param samples: Number of samples to generate.
@@ -270,14 +300,25 @@ class StabilityInference:
         if negative_prompt:
             prompt += [generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1))]
 
+        cfg_scales = []
+        if isinstance(cfg_scale, Sequence):
+            cfg_scales, cfg_scale = list(cfg_scale), cfg_scale[0]
+
+        sampler_parameters = generation.SamplerParameters(
+            cfg_scale=cfg_scale,
+            cfg_scales=cfg_scales,
+            eta=eta,
+            sigma_schedule=sigma_schedule,
+        )
+        if guidance_cutoff is not None: sampler_parameters.guidance_cutoff = guidance_cutoff
+        if guidance_cutoff_delta is not None: sampler_parameters.guidance_cutoff_delta = guidance_cutoff_delta
+        if tile_size is not None: sampler_parameters.tile_size = tile_size
+
         if (init_image is not None):
             prompt += [image_to_prompt(init_image, init=True)]
             parameters = generation.StepParameter(
                     scaled_step=0,
-                    sampler=generation.SamplerParameters(
-                        cfg_scale=cfg_scale,
-                        eta=eta,
-                    ),
+                    sampler=sampler_parameters,
                     schedule=generation.ScheduleParameters(
                         start=start_schedule,
                         end=end_schedule,
@@ -288,10 +329,7 @@ class StabilityInference:
         else:
             parameters = generation.StepParameter(
                     scaled_step=0,
-                    sampler=generation.SamplerParameters(
-                        cfg_scale=cfg_scale,
-                        eta=eta,
-                    ),
+                    sampler=sampler_parameters,
                 ),
 
         rq = generation.Request(
@@ -358,6 +396,10 @@ def build_request_dict(cli_args: Namespace) -> Dict[str, Any]:
         "cfg_scale": cli_args.cfg_scale,
         "eta": cli_args.eta,
         "sampler": get_sampler_from_str(cli_args.sampler),
+        "sigma_schedule": get_sigma_schedule_from_str(cli_args.sigma_schedule),
+        "guidance_cutoff": cli_args.guidance_cutoff,
+        "guidance_cutoff_delta": cli_args.guidance_cutoff_delta,
+        "tile_size": cli_args.tile_size,
         "steps": cli_args.steps,
         "seed": cli_args.seed,
         "samples": cli_args.num_samples,
@@ -420,9 +462,24 @@ if __name__ == "__main__":
         default="k_lms",
         help="[k_lms] (" + ", ".join(algorithms.keys()) + ")",
     )
+    parser.add_argument(
+        "--sigma_schedule",
+        type=str,
+        default="default",
+        help="[default] spacing of the noise levels for the k_* and unipc samplers (" + ", ".join(sigma_schedules.keys()) + ")",
+    )
     parser.add_argument(
         "--steps", "-s", type=int, default=50, help="[50] number of steps"
     )
+    parser.add_argument(
+        "--guidance_cutoff", type=float, default=None, help="[None] stop classifier free guidance after this fraction of the steps (e.g. 0.7)"
+    )
+    parser.add_argument(
+        "--guidance_cutoff_delta", type=float, default=None, help="[None] stop classifier free guidance once the cond / uncond difference is below this"
+    )
+    parser.add_argument(
+        "--tile_size", type=int, default=None, help="[None] denoise images larger than this as overlapping tiles of this size (e.g. 512)"
+    )
     parser.add_argument("--seed", "-S", type=int, default=0, help="random seed to use")
     parser.add_argument(
         "--prefix",
@@ -0,0 +1,327 @@
+import threading, time
+from types import SimpleNamespace as SN
+
+from sdgrpcserver.costmodel import CostModel
+
+class AllSetEvent(object):
+    """Looks like a threading.Event to the pipeline, but is only set once every wrapped event is set"""
+
+    def __init__(self, events):
+        self._events = [event for event in events if event is not None]
+
+    def is_set(self):
+        return bool(self._events) and all(event.is_set() for event in self._events)
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted to a GenerationBatcher that already has max_queue_length jobs waiting"""
+    pass
+
+class BatchJob(object):
+    """
+    A single call to PipelineWrapper.generate, waiting to be run by a GenerationBatcher
+
+    params.seed can be a list, in which case the job generates one image per seed. text and params.cfg_scale
+    can then also be lists, with one entry per seed
+
+    client identifies who submitted the job (for fair sharing between clients), and priority sets how big a
+    share that client gets - each step up doubles the share
+    """
+
+    def __init__(self, engine_id, text, params, image=None, mask=None, outmask=None, negative_text=None, stop_event=None, client=None, priority=0):
+        self.engine_id = engine_id
+        self.text = text
+        self.params = params
+        self.image = image
+        self.mask = mask
+        self.outmask = outmask
+        self.negative_text = negative_text
+        self.stop_event = stop_event
+
+        self.client = client
+        self.priority = priority
+
+        self.submitted = time.monotonic()
+        self.started = None
+        self.bypassed = 0
+        # Estimated seconds to run, set by GenerationBatcher when the job is queued
+        self.estimate = 0
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+    @property
+    def rows(self):
+        return len(self.params.seed) if isinstance(self.params.seed, list) else 1
+
+    @property
+    def weight(self):
+        return 2.0 ** self.priority
+
+    @property
+    def wait_time(self):
+        """How long the job waited in the queue (so far, if it hasn't started yet)"""
+        return (self.started or time.monotonic()) - self.submitted
+
+    @property
+    def key(self):
+        """Jobs with the same key can be run as a single batch"""
+        # Only txt2img requests can be combined - img2img and inpainting jobs only ever batch with themselves
+        if self.image is not None: return ("unique", id(self))
+
+        params = self.params
+        return (
+            self.engine_id, params.width, params.height, params.steps, params.sampler, params.eta, 
+            getattr(params, "sigma_schedule", None), getattr(params, "guidance_cutoff", None), getattr(params, "guidance_cutoff_delta", None),
+            getattr(params, "tile_size", None)
+        )
+
+    @property
+    def cancelled(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def resolve(self, results=None, error=None):
+        self.results = results
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error: raise self.error
+        return self.results
+
+class GenerationBatcher(object):
+    """
+    Sits between GenerationServiceServicer and PipelineWrapper.generate. Collects concurrent jobs that are
+    compatible (same engine, size, steps, sampler, sigma schedule and mode) for up to `window` seconds, and then runs them
+    as a single batch through the pipeline, with per-job prompts, seeds and guidance scales.
+
+    Waiting jobs are shared fairly between clients: each client is charged for the work it has had run
+    (divided by the job's priority weight), and the client that has been charged least goes next. Charges 
+    are kept between jobs and requests (so a client sending a long run of requests, or a request in many 
+    chunks, yields to one that has had less), halving every `usage_half_life` seconds. At most 
+    `max_queue_length` jobs can wait (0 = unlimited), after which submit raises QueueFullError.
+
+    A client's own jobs run shortest (by estimated run time) first, with aging - every second a job waits
+    takes `aging` seconds off its estimate - so big jobs still get their turn. The estimates come from a
+    CostModel that is calibrated from how long batches actually take.
+
+    Jobs for the engine that ran last are served ahead of jobs for other engines, to avoid swapping
+    pipelines back and forth. To stop other engines starving, a job is never passed over once it has waited
+    more than `max_engine_wait` seconds, or been passed over `max_engine_bypass` times.
+
+    All generation runs on a single worker thread, so the GPU only ever has one batch in flight.
+    """
+
+    def __init__(self, manager, window=0.05, max_batch_size=4, max_engine_wait=30, max_engine_bypass=8, max_queue_length=0, aging=1.0, usage_half_life=60, cost_model=None):
+        self._manager = manager
+        self._cost_model = cost_model if cost_model else CostModel()
+        self._aging = aging
+        self._window = window
+        self._max_batch_size = max(max_batch_size, 1)
+        self._max_engine_wait = max_engine_wait
+        self._max_engine_bypass = max_engine_bypass
+        self._max_queue_length = max_queue_length
+        self._usage_half_life = usage_half_life
+
+        self._pending = []
+        self._cond = threading.Condition()
+
+        # How much work each client has been charged for recently, and when the charges were last decayed
+        self._usage = {}
+        self._usage_decayed = time.monotonic()
+
+        self._last_engine_id = None
+        self._swaps = 0
+
+        self._thread = threading.Thread(target=self._run, name="GenerationBatcher", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, job):
+        """Add a job to the queue, and return it's position in the queue (1 = next)"""
+        with self._cond:
+            if self._max_queue_length and len(self._pending) >= self._max_queue_length:
+                raise QueueFullError(f"Queue is full ({len(self._pending)} jobs waiting)")
+
+            job.estimate = self._cost_model.estimate(job.engine_id, self._units(job))
+
+            # A client keeps it's (decayed) charge from earlier jobs, and a new one starts from nothing. So a newcomer
+            # goes ahead of a client that has had a lot run recently, but only until it's had as much itself - 
+            # idle time can't be banked beyond what other clients' charges have decayed to
+            self._decayUsage()
+            self._usage.setdefault(job.client, 0)
+
+            self._pending.append(job)
+            self._cond.notify_all()
+
+            return self._fairOrder().index(job) + 1
+
+    def submit(self, job):
+        """Add a job to the queue and block until it has been run. Returns (images, nsfw) for the job"""
+        self.enqueue(job)
+        return job.wait()
+
+    @property
+    def max_batch_size(self):
+        return self._max_batch_size
+
+    def getStats(self):
+        """Returns the number of engine swaps so far, and the number of queued jobs for each engine"""
+        with self._cond:
+            depth = {}
+            for job in self._pending: depth[job.engine_id] = depth.get(job.engine_id, 0) + 1
+            return dict(
+                swaps=self._swaps, 
+                last_engine_id=self._last_engine_id, 
+                queue_depth=depth, 
+                queue_length=len(self._pending),
+                seconds_per_unit=self._cost_model.getStats()
+            )
+
+    def _decayUsage(self):
+        """Decay every client's charge by the time since the last decay, and forget idle clients once it's negligible"""
+        now = time.monotonic()
+        factor = 0.5 ** ((now - self._usage_decayed) / self._usage_half_life) if self._usage_half_life else 0
+        self._usage_decayed = now
+
+        waiting = set(job.client for job in self._pending)
+        for client in list(self._usage.keys()):
+            self._usage[client] *= factor
+            if client not in waiting and self._usage[client] < 1e-3: del self._usage[client]
+
+    def _units(self, job):
+        return self._cost_model.units(job.params, rows=job.rows, has_image=job.image is not None)
+
+    def _fairOrder(self):
+        """Waiting jobs, least charged client first (higher priority first between equals), and shortest (after aging) first for each client"""
+        now = time.monotonic()
+        return sorted(self._pending, key=lambda job: (
+            self._usage[job.client], 
+            -job.priority,
+            job.estimate - (now - job.submitted) * self._aging, 
+            job.submitted
+        ))
+
+    def _selectFirst(self, order):
+        """Pick the job to build the next batch around"""
+        best = order[0]
+
+        if best.engine_id == self._last_engine_id: return best
+        if time.monotonic() - best.submitted >= self._max_engine_wait: return best
+        if best.bypassed >= self._max_engine_bypass: return best
+
+        # Prefer the next job for the engine that's already active
+        for job in order:
+            if job.engine_id == self._last_engine_id: return job
+
+        return best
+
+    def _collect(self):
+        with self._cond:
+            while True:
+                # Drop any jobs that were cancelled while waiting
+                for job in [job for job in self._pending if job.cancelled]:
+                    self._pending.remove(job)
+                    job.resolve(results=([], []))
+
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+
+                order = self._fairOrder()
+                first = self._selectFirst(order)
+                compatible = [job for job in order if job.key == first.key]
+
+                batch, rows = [], 0
+                for job in compatible:
+                    if batch and rows + job.rows > self._max_batch_size: break
+                    batch.append(job)
+                    rows += job.rows
+
+                remaining = first.submitted + self._window - time.monotonic()
+
+                if len(batch) < len(compatible) or rows >= self._max_batch_size or remaining <= 0:
+                    # Any job that should have gone first, but is for a different engine, has been passed over
+                    for job in order[:order.index(first)]:
+                        if job.engine_id != first.engine_id: job.bypassed += 1
+
+                    self._decayUsage()
+                    for job in batch: 
+                        self._pending.remove(job)
+                        self._usage[job.client] += job.estimate / job.weight
+                        job.started = time.monotonic()
+
+                    if self._last_engine_id is not None and first.engine_id != self._last_engine_id:
+                        self._swaps += 1
+                        depth = sum(1 for job in self._pending if job.engine_id == self._last_engine_id)
+                        print(f"Swapping engine {self._last_engine_id} -> {first.engine_id} ({self._swaps} swaps so far, {depth} jobs left for {self._last_engine_id})")
+                    self._last_engine_id = first.engine_id
+
+                    return batch
+
+                self._cond.wait(remaining)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            try:
+                results = self._process(batch)
+            except Exception as e:
+                for job in batch: job.resolve(error=e)
+            else:
+                for job, result in zip(batch, results): job.resolve(results=result)
+
+    def _process(self, batch):
+        # Don't include activating the engine in the timing, only the generation itself
+        pipe = self._manager.getPipe(batch[0].engine_id)
+
+        start = time.monotonic()
+        results = self._generate(pipe, batch)
+
+        # Cancelled batches stop early, so don't tell us how long the work would have taken
+        if not any(job.cancelled for job in batch):
+            self._cost_model.observe(pipe.id, sum(self._units(job) for job in batch), time.monotonic() - start)
+
+        return results
+
+    def _generate(self, pipe, batch):
+        first = batch[0]
+
+        if len(batch) == 1:
+            return [pipe.generate(
+                text=first.text, params=first.params,
+                image=first.image, mask=first.mask, outmask=first.outmask,
+                negative_text=first.negative_text,
+                stop_event=first.stop_event
+            )]
+
+        text, negative_text, seeds, cfg_scales = [], [], [], []
+        for job in batch:
+            job_seeds = job.params.seed if isinstance(job.params.seed, list) else [job.params.seed]
+            seeds += job_seeds
+            # A job can already have one prompt per seed (a multi-prompt request)
+            if isinstance(job.text, list): text += job.text
+            else: text += [job.text] * len(job_seeds)
+            negative_text += [job.negative_text or ""] * len(job_seeds)
+            # A job can already have one scale per seed (a guidance scale sweep)
+            if isinstance(job.params.cfg_scale, list): cfg_scales += job.params.cfg_scale
+            else: cfg_scales += [job.params.cfg_scale] * len(job_seeds)
+
+        params = SN(**vars(first.params))
+        params.seed = seeds
+        params.cfg_scale = cfg_scales
+
+        print(f"Batching {len(batch)} requests into a batch of {len(seeds)}")
+
+        images, nsfw = pipe.generate(
+            text=text, params=params,
+            negative_text=negative_text,
+            stop_event=AllSetEvent([job.stop_event for job in batch])
+        )
+
+        results, offset = [], 0
+        for job in batch:
+            results.append((images[offset:offset+job.rows], nsfw[offset:offset+job.rows]))
+            offset += job.rows
+
+        return results
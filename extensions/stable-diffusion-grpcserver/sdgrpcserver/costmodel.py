@@ -0,0 +1,62 @@
+import threading
+
+import generation_pb2
+
+# How many UNet evaluations each sampler does per step
+SAMPLER_NFE = {
+    generation_pb2.SAMPLER_K_HEUN: 2,
+    generation_pb2.SAMPLER_K_DPM_2: 2,
+    generation_pb2.SAMPLER_K_DPM_2_ANCESTRAL: 2,
+}
+
+class CostModel(object):
+    """
+    Estimates how long a generation job will take to run.
+
+    The work in a job is measured in units of "one UNet evaluation of one 512x512 image", calculated from the
+    job's size, steps, samples and sampler. The time per unit is learnt per engine from how long batches
+    actually take to run (as an exponential moving average), starting from `initial_seconds_per_unit`.
+    """
+
+    def __init__(self, initial_seconds_per_unit=0.1, smoothing=0.2):
+        self._initial = initial_seconds_per_unit
+        self._smoothing = smoothing
+        self._seconds_per_unit = {}
+        self._lock = threading.Lock()
+
+    def units(self, params, rows=1, has_image=False):
+        pixels = (params.width * params.height) / (512 * 512)
+
+        # Img2img and inpainting skip the first (1 - strength) of the steps
+        steps = params.steps
+        if has_image: steps = max(1, int(steps * min(params.strength, 1)))
+
+        units = pixels * steps * rows * SAMPLER_NFE.get(params.sampler, 1)
+
+        # With truncated guidance, the steps after the cutoff only run the conditional half of the batch
+        cutoff = getattr(params, "guidance_cutoff", None)
+        if cutoff is not None: units *= (1 + min(max(cutoff, 0), 1)) / 2
+
+        return units
+
+    def secondsPerUnit(self, engine_id):
+        with self._lock:
+            return self._seconds_per_unit.get(engine_id, self._initial)
+
+    def estimate(self, engine_id, units):
+        """Estimated seconds to run `units` of work on an engine"""
+        return units * self.secondsPerUnit(engine_id)
+
+    def observe(self, engine_id, units, seconds):
+        """Update the model with the measured time taken to run `units` of work on an engine"""
+        if units <= 0 or seconds <= 0: return
+
+        with self._lock:
+            measured = seconds / units
+            current = self._seconds_per_unit.get(engine_id)
+            if current is None: self._seconds_per_unit[engine_id] = measured
+            else: self._seconds_per_unit[engine_id] = current + (measured - current) * self._smoothing
+
+    def getStats(self):
+        with self._lock:
+            return dict(self._seconds_per_unit)
@@ -1,24 +1,33 @@
 
-import os, warnings
+import os, copy, warnings, threading
+from collections import OrderedDict
+from types import SimpleNamespace as SN
 from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin
 import torch
 
 from tqdm.auto import tqdm
 
-# Patch attention to use MemoryEfficientCrossAttention if xformers is available
+# Patch attention to use BackendCrossAttention, so each engine's attention backend can be chosen
 from diffusers.models import attention
-from sdgrpcserver.pipeline.fastattention import has_xformers, MemoryEfficientCrossAttention
-print(f"Using xformers: {'yes' if has_xformers() else 'no'}")
-if has_xformers(): attention.CrossAttention = MemoryEfficientCrossAttention
+from sdgrpcserver.pipeline.fastattention import BackendCrossAttention, available_attention_backends, best_attention_backend, set_attention_backend
+print(f"Attention backends available: {', '.join(available_attention_backends())}")
+attention.CrossAttention = BackendCrossAttention
 
 from diffusers import StableDiffusionPipeline, LMSDiscreteScheduler, PNDMScheduler
 from diffusers.configuration_utils import FrozenDict
 from diffusers.utils import deprecate
-from diffusers.models import AutoencoderKL
+from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+from huggingface_hub import snapshot_download
+from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 
 import generation_pb2
 
+from sdgrpcserver.memorymodel import MemoryModel, is_out_of_memory
 from sdgrpcserver.pipeline.unified_pipeline import UnifiedPipeline
+from sdgrpcserver.pipeline.tiling import TILE_OVERLAP, tiles
+from sdgrpcserver.pipeline.caches import TensorLRUCache
+from sdgrpcserver.pipeline.randtools import LatentNoiseFactory
 from sdgrpcserver.pipeline.safety_checkers import FlagOnlySafetyChecker
 
 from sdgrpcserver.pipeline.schedulers.scheduling_ddim import DDIMScheduler
@@ -27,6 +36,14 @@ from sdgrpcserver.pipeline.old_schedulers.scheduling_euler_ancestral_discrete im
 from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_discrete import DPM2DiscreteScheduler
 from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_ancestral_discrete import DPM2AncestralDiscreteScheduler
 from sdgrpcserver.pipeline.old_schedulers.scheduling_heun_discrete import HeunDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_dpmpp_2m_discrete import DPMPP2MDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_unipc_discrete import UniPCDiscreteScheduler
+
+# SigmaSchedule values to the names build_sigma_schedule takes (SIGMA_SCHEDULE_DEFAULT, or unset, is None)
+sigma_schedules = {
+    generation_pb2.SIGMA_SCHEDULE_KARRAS: "karras",
+    generation_pb2.SIGMA_SCHEDULE_EXPONENTIAL: "exponential",
+}
 
 class WithNoop(object):
     def __enter__(self):
@@ -62,11 +79,90 @@ class ProgressBarWrapper(object):
         return ProgressBarWrapper.InternalTqdm(self._progress_callback, self._stop_event, iterable)
     
 
+class ComponentRegistry(object):
+    """
+    Loads pipeline components (models, tokenizers, feature extractors), keeping a single instance for each
+    unique (class, weight path, subfolder, dtype, revision). Engines that use the same weights get the same
+    component by reference, so memory and load time scale with the unique weights, not the number of engines.
+
+    Components are downloaded and loaded outside the registry lock, so loads of different components (say, a 
+    background prefetch of one engine and an on demand load of another) run at the same time. Concurrent requests 
+    for the same component wait for the one load.
+    """
+
+    def __init__(self):
+        # Each key maps to an entry whose `loaded` event is set once the component (or the error loading it) is there
+        self._components = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _resolvePath(self, weight_path, revision, use_auth_token):
+        # Download (or find in the cache) the whole repo, the same as DiffusionPipeline.from_pretrained does
+        if os.path.isdir(weight_path): return weight_path
+        return snapshot_download(weight_path, revision=revision, use_auth_token=use_auth_token)
+
+    def get(self, cls, weight_path, subfolder=None, dtype=None, revision=None, use_auth_token=False):
+        key = (cls, weight_path, subfolder, dtype, revision)
+
+        with self._lock:
+            entry = self._components.get(key)
+            loading = entry is None
+
+            if loading:
+                entry = SN(loaded=threading.Event(), component=None, error=None)
+                self._components[key] = entry
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if not loading:
+            entry.loaded.wait()
+            if entry.error: raise entry.error
+            return entry.component
+
+        try:
+            path = self._resolvePath(weight_path, revision, use_auth_token)
+            if subfolder: path = os.path.join(path, subfolder)
+
+            kwargs = {"torch_dtype": dtype} if dtype is not None and issubclass(cls, torch.nn.Module) else {}
+            entry.component = cls.from_pretrained(path, **kwargs)
+        except Exception as e:
+            # Pass the error to anyone waiting, and forget the entry so the next request tries again
+            with self._lock: 
+                del self._components[key]
+                self.misses -= 1
+            entry.error = e
+            raise
+        finally:
+            entry.loaded.set()
+
+        return entry.component
+
+    def componentId(self, component):
+        """A stable identifier for a component loaded by the registry (from it's class and weights), or None if it wasn't"""
+        with self._lock:
+            for (cls, weight_path, subfolder, dtype, revision), entry in self._components.items():
+                if entry.component is component: return f"{cls.__name__}:{weight_path}:{subfolder}:{dtype}:{revision}"
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return sum(1 for entry in self._components.values() if entry.component is not None)
+
 class EngineMode(object):
-    def __init__(self, vram_optimisation_level=0, enable_cuda = True, enable_mps = False):
+    def __init__(self, vram_optimisation_level=0, enable_cuda = True, enable_mps = False, auto_optimise = True, attention_backend = None):
         self._vramO = vram_optimisation_level
         self._enable_cuda = enable_cuda
         self._enable_mps = enable_mps
+        self._auto_optimise = auto_optimise
+
+        # Resolved once here (rather than on each use), so a missing backend is only warned about once
+        if attention_backend and attention_backend not in available_attention_backends():
+            print(f"Warning: attention backend {attention_backend} isn't available here, using {best_attention_backend(self.device)} instead")
+            attention_backend = None
+
+        self._attention_backend = attention_backend
     
     @property
     def device(self):
@@ -86,15 +182,93 @@ class EngineMode(object):
     def module_mode(self):
         return "one" if self.device == "cuda" and self._vramO > 2 else "all"
 
+    @property
+    def attention_backend(self):
+        """
+        Which of fastattention's ATTENTION_BACKENDS the UNets use. Defaults to the best available on the device, 
+        which is also used (with a warning) if the one asked for isn't available here
+        """
+        return self._attention_backend or best_attention_backend(self.device)
+
+    @property
+    def auto_optimise(self):
+        """
+        Whether to choose attention slicing, VAE tiling and batch sizes per request from the predicted peak memory 
+        (see MemoryModel) rather than using the fixed settings below. Needs CUDA to measure free memory, and all 
+        the modules on the device (so not module_mode "one"). fp16 and module_mode are still set by the level
+        """
+        return self._auto_optimise and self.device == "cuda" and self.module_mode == "all"
+
+    @property
+    def batch_pixels(self):
+        """How many pixels worth of images to denoise in a single batch. Larger batches are quicker, but need more memory"""
+        if self.device != "cuda": return 512 * 512 * 4
+        return 512 * 512 * (8 if self._vramO == 0 else 4 if self._vramO == 1 else 2 if self._vramO == 2 else 1)
+
+    @property
+    def vae_tile_pixels(self):
+        """
+        How many pixels the VAE encodes or decodes at once. Bigger batches are split up, and a single image bigger
+        than this is tiled. Tiling can leave faint seams and colour shifts (the VAE's GroupNorm sees each tile's
+        statistics, not the whole image's), so this is set well above the usual generation sizes - at any level an 
+        image of up to 1024x1024 is decoded whole. None (no limit) off CUDA, where the VAE runs in system memory
+        """
+        if self.device != "cuda": return None
+        return 1024 * 1024 * (4 if self._vramO == 0 else 2 if self._vramO == 1 else 1)
+
+class PeakMemoryMeter(object):
+    """
+    Measures the peak CUDA memory of a generation. torch keeps a single peak for the whole process, so resetting it
+    for one generation would spoil the measurement of any other running at the same time. Every generation is
+    counted in and out, and a peak is only reset and read for one that had the device to itself from start to finish
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._started = 0
+
+    def start(self, measure):
+        """Count a generation in. Returns a token to pass to finish, which is None if it won't be measured"""
+        with self._lock:
+            self._active += 1
+            self._started += 1
+            if not measure or self._active > 1: return None
+
+            torch.cuda.reset_peak_memory_stats()
+            return SN(started=self._started, baseline=torch.cuda.memory_allocated())
+
+    def finish(self, token):
+        """Count a generation out. Returns the bytes it used above the baseline, or None if it wasn't measured"""
+        with self._lock:
+            self._active -= 1
+            # If another generation started in the meantime, the peak could be theirs
+            if token is None or self._started != token.started: return None
+
+            return torch.cuda.max_memory_allocated() - token.baseline
+
+peak_memory_meter = PeakMemoryMeter()
+
+def modules_memory_size(modules):
+    """How many bytes of weights a list of modules has, counting any module that's listed more than once only once"""
+    unique = {id(module): module for module in modules}.values()
+    tensors = [tensor for module in unique for tensor in list(module.parameters()) + list(module.buffers())]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
 class PipelineWrapper(object):
 
-    def __init__(self, id, mode, pipeline):
+    def __init__(self, id, mode, pipeline, memory_model=None):
         self._id = id
         self._mode = mode
+        self._memory_model = memory_model if memory_model else MemoryModel()
 
         self._pipeline = pipeline
+        # Pipelines that can't take a scheduler per call need their shared scheduler protecting
+        self._pipelineLock = threading.Lock()
 
+        set_attention_backend(self._pipeline.unet, self.mode.attention_backend)
         self._pipeline.enable_attention_slicing(1 if self.mode.attention_slice else None)
+        if isinstance(self._pipeline, UnifiedPipeline): self._pipeline.enable_vae_tiling(self.mode.vae_tile_pixels)
         self._pipeline.set_module_mode(self.mode.module_mode)
 
         self._plms = self._prepScheduler(PNDMScheduler(
@@ -147,6 +321,19 @@ class PipelineWrapper(object):
                 beta_schedule="scaled_linear",
                 num_train_timesteps=1000
             ))
+        self._dpmpp2m = self._prepScheduler(DPMPP2MDiscreteScheduler(
+                beta_start=0.00085, 
+                beta_end=0.012, 
+                beta_schedule="scaled_linear",
+                num_train_timesteps=1000
+            ))
+        self._unipc = self._prepScheduler(UniPCDiscreteScheduler(
+                beta_start=0.00085, 
+                beta_end=0.012, 
+                beta_schedule="scaled_linear",
+                num_train_timesteps=1000,
+                solver_order=2
+            ))
 
     def _prepScheduler(self, scheduler):
         if isinstance(scheduler, OldSchedulerMixin):
@@ -168,6 +355,18 @@ class PipelineWrapper(object):
 
         return scheduler
 
+    def _cloneScheduler(self, scheduler):
+        """
+        Make a copy of a scheduler to use for a single run. Tensors computed at construction (betas, alphas, etc)
+        are only read, so are shared. Per-run state (timesteps, sigmas, the old schedulers' SamplerState) is replaced 
+        by set_timesteps, and any lists that get appended to (derivatives, ets, ...) are copied, so runs never see 
+        each other's state.
+        """
+        clone = copy.copy(scheduler)
+        for key, value in vars(clone).items():
+            if isinstance(value, list): setattr(clone, key, list(value))
+        return clone
+
     @property
     def id(self): return self._id
 
@@ -182,12 +381,101 @@ class PipelineWrapper(object):
         self._pipeline.to("cpu", forceAll=True)
         if self.mode.device == "cuda": torch.cuda.empty_cache()
 
+    @property
+    def modules(self):
+        """The torch modules this pipeline moves to the device when activated (which may be shared with other pipelines)"""
+        return [module for module in vars(self._pipeline).values() if isinstance(module, torch.nn.Module)]
+
+    @property
+    def memory_size(self):
+        """How many bytes of weights this pipeline moves to the device when activated"""
+        return modules_memory_size(self.modules)
+
+    @property
+    def supports_batching(self):
+        return isinstance(self._pipeline, UnifiedPipeline)
+
+    def _buildGenerator(self, seed):
+        latents_device = "cpu" if self._pipeline.device.type == "mps" else self._pipeline.device
+
+        # A list of seeds gets a generator per seed, so each image is independant of the rest of the batch
+        if isinstance(seed, list): return LatentNoiseFactory.fromSeeds(seed, latents_device)
+        if seed > 0: return torch.Generator(latents_device).manual_seed(seed)
+
+        return None
+
+    def _batchTotal(self, text, negative_text, params):
+        for value in (text, negative_text, params.seed, params.cfg_scale):
+            if isinstance(value, list): return len(value)
+        return None
+
+    def _availableMemory(self):
+        """Bytes of device memory free for activations - unused memory, plus memory torch has reserved but isn't using"""
+        device = torch.device(self.mode.device)
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    def _planMemory(self, params, rows):
+        """Choose settings for this request from the predicted peak memory, or None if the mode uses fixed settings"""
+        if not (self.supports_batching and self.mode.auto_optimise): return None
+
+        heads = self._pipeline.unet.config.attention_head_dim
+        if isinstance(heads, (list, tuple)): heads = max(heads)
+
+        tile_size = getattr(params, "tile_size", None)
+        tile_count = 1
+        if tile_size:
+            tile_count = len(list(tiles(params.height // 8, params.width // 8, tile_size // 8, TILE_OVERLAP // 8)))
+            if tile_count == 1: tile_size = None
+
+        return self._memory_model.plan(
+            self.id, params.width, params.height, rows, heads, 2 if self.mode.fp16 else 4, self._availableMemory(), 
+            tile_size=tile_size, tile_count=tile_count, attention_backend=self.mode.attention_backend
+        )
+
     def generate(self, text, params, image=None, mask=None, outmask=None, negative_text=None, progress_callback=None, stop_event=None):
-        generator=None
+        """
+        Generate images. To generate several images in a single batch, text, negative_text, params.seed and
+        params.cfg_scale can each be a list with one entry per image. Otherwise one image is generated.
 
-        if params.seed > 0:
-            latents_device = "cpu" if self._pipeline.device.type == "mps" else self._pipeline.device
-            generator = torch.Generator(latents_device).manual_seed(params.seed)
+        If a batch runs out of memory it is split in half and retried (each image keeps it's seed, so the
+        results are the same), and the size that worked is remembered for this engine and resolution.
+        """
+        batch_total = self._batchTotal(text, negative_text, params)
+        plan = self._planMemory(params, batch_total or 1)
+
+        if batch_total:
+            if not self.supports_batching: micro_batch_size = 1
+            elif plan: micro_batch_size = plan.micro_batch_size
+            else: micro_batch_size = max(1, self.mode.batch_pixels // (params.width * params.height))
+
+            limit = self._memory_model.batchLimit(self.id, params.width, params.height)
+            if limit: micro_batch_size = min(micro_batch_size, limit)
+
+            if batch_total > micro_batch_size:
+                return self._generateInMicroBatches(batch_total, micro_batch_size, text, params, image, mask, outmask, negative_text, progress_callback, stop_event)
+
+        try:
+            return self._generateBatch(batch_total, plan, text, params, image, mask, outmask, negative_text, progress_callback, stop_event)
+        except RuntimeError as e:
+            # A single image can't be split, and anything other than running out of memory is a real error
+            if not (batch_total and batch_total > 1 and is_out_of_memory(e)): raise
+
+        # Retry outside the except block, so the tensors the failed attempt's traceback holds on to are freed first
+        half = (batch_total + 1) // 2
+        print(f"Out of memory generating {batch_total} images of {params.width}x{params.height} on {self.id}, retrying {half} at a time")
+
+        self._memory_model.limitBatch(self.id, params.width, params.height, half)
+        if self.mode.device == "cuda": torch.cuda.empty_cache()
+
+        return self._generateInMicroBatches(batch_total, half, text, params, image, mask, outmask, negative_text, progress_callback, stop_event)
+
+    def _generateBatch(self, batch_total, plan, text, params, image, mask, outmask, negative_text, progress_callback, stop_event):
+        generator = self._buildGenerator(params.seed)
+
+        if batch_total:
+            if isinstance(text, str): text = [text] * batch_total
+            if negative_text is not None and isinstance(negative_text, str): negative_text = [negative_text] * batch_total
 
         if params.sampler is None or params.sampler == generation_pb2.SAMPLER_DDPM:
             scheduler=self._plms
@@ -205,15 +493,21 @@ class PipelineWrapper(object):
             scheduler=self._dpm2a
         elif params.sampler == generation_pb2.SAMPLER_K_HEUN:
             scheduler=self._heun
+        elif params.sampler == generation_pb2.SAMPLER_K_DPMPP_2M:
+            scheduler=self._dpmpp2m
+        elif params.sampler == generation_pb2.SAMPLER_UNIPC:
+            scheduler=self._unipc
         else:
             raise NotImplementedError("Scheduler not implemented")
 
-        self._pipeline.scheduler = scheduler
-        self._pipeline.progress_bar = ProgressBarWrapper(progress_callback, stop_event)
+        sigma_schedule = sigma_schedules.get(getattr(params, "sigma_schedule", None))
+
+        scheduler = self._cloneScheduler(scheduler)
+        progress_bar = ProgressBarWrapper(progress_callback, stop_event)
 
-        images = self._pipeline(
+        kwargs = dict(
             prompt=text,
-            negative_prompt=negative_text if negative_text else None,
+            negative_prompt=negative_text if negative_text and any(negative_text) else None,
             init_image=image,
             mask_image=mask,
             outmask_image=outmask,
@@ -228,18 +522,102 @@ class PipelineWrapper(object):
             return_dict=False
         )
 
-        return images
+        # UnifiedPipeline takes the scheduler, progress bar and memory settings per call, so concurrent requests are safe
+        if self.supports_batching:
+            tile_size = getattr(params, "tile_size", None)
+
+            if plan:
+                memory_kwargs = dict(attention_slice=plan.attention_slice, vae_tile_pixels=plan.vae_tile_pixels, tile_batch_size=plan.tile_batch_size)
+            else:
+                # Fill each UNet call with as many tiles as the batch pixel budget allows (each tile is run for every row of the batch)
+                rows = len(text) if isinstance(text, list) else 1
+                memory_kwargs = dict(tile_batch_size=max(1, self.mode.batch_pixels // (tile_size * tile_size * rows)) if tile_size else None)
+
+            token = peak_memory_meter.start(measure=plan is not None) if self.mode.device == "cuda" else None
+            measured = None
+
+            try:
+                result = self._pipeline(
+                    **kwargs, 
+                    **memory_kwargs,
+                    sigma_schedule=sigma_schedule,
+                    guidance_cutoff=getattr(params, "guidance_cutoff", None),
+                    guidance_cutoff_delta=getattr(params, "guidance_cutoff_delta", None),
+                    tile_size=tile_size,
+                    scheduler=scheduler, progress_bar=progress_bar
+                )
+            finally:
+                if self.mode.device == "cuda": measured = peak_memory_meter.finish(token)
+
+            if plan and measured is not None: self._memory_model.observe(self.id, plan.peak, measured)
+
+            return result
+
+        # Other pipelines only use the attributes on the pipeline, so they can only run one request at a time
+        with self._pipelineLock:
+            self._pipeline.scheduler = scheduler
+            self._pipeline.progress_bar = progress_bar
+
+            token = peak_memory_meter.start(measure=False) if self.mode.device == "cuda" else None
+            try:
+                return self._pipeline(**kwargs)
+            finally:
+                if self.mode.device == "cuda": peak_memory_meter.finish(token)
+
+    def _generateInMicroBatches(self, batch_total, micro_batch_size, text, params, image, mask, outmask, negative_text, progress_callback, stop_event):
+        """
+        Split a batch that is too large to generate at once into smaller batches. Since each image
+        has it's own seed, the results are the same as if the batch had been generated in one go.
+        A micro_batch_size of 1 is used for pipelines that can't batch with per-image arguments.
+        """
+        if micro_batch_size == 1: chunk = lambda value, i: value[i] if isinstance(value, list) else value
+        else: chunk = lambda value, i: value[i:i+micro_batch_size] if isinstance(value, list) else value
+
+        images, nsfw = [], []
+        for i in range(0, batch_total, micro_batch_size):
+            if stop_event and stop_event.is_set(): break
+
+            chunk_params = SN(**vars(params))
+            chunk_params.seed = chunk(params.seed, i)
+            chunk_params.cfg_scale = chunk(params.cfg_scale, i)
+
+            chunk_images, chunk_nsfw = self.generate(
+                chunk(text, i), chunk_params, 
+                image=image, mask=mask, outmask=outmask, negative_text=chunk(negative_text, i), 
+                progress_callback=progress_callback, stop_event=stop_event
+            )
+
+            images.extend(chunk_images)
+            nsfw.extend(chunk_nsfw)
+
+        return images, nsfw
 
 class EngineManager(object):
 
-    def __init__(self, engines, weight_root="./weights", mode=EngineMode(), nsfw_behaviour="block"):
+    def __init__(self, engines, weight_root="./weights", mode=EngineMode(), nsfw_behaviour="block", memory_budget=0, text_embedding_cache_size=0, init_latent_cache_size=0):
         self.engines = engines
         self._default = None
         self._pipelines = {}
-        self._activeId = None
-        self._active = None
+
+        # Engines currently being loaded, and an event that is set once they are done
+        self._loading = {}
+        self._loadingLock = threading.Lock()
+
+        # Pipelines currently on the device, least recently used first
+        self._resident = OrderedDict()
+        self._residentLock = threading.Lock()
+        self._memory_budget = memory_budget
+        self._residency_stats = SN(hits=0, misses=0, evictions=0)
 
         self._weight_root = weight_root
+        self._components = ComponentRegistry()
+
+        # Shared by all engines - entries are keyed by text encoder, so engines that share one share entries too
+        self._text_embedding_cache = TensorLRUCache(text_embedding_cache_size)
+        self._init_latent_cache = TensorLRUCache(init_latent_cache_size)
+
+        # Shared by all engines, but learns a correction per engine
+        self._memory_model = MemoryModel()
 
         self._mode = mode
         self._nsfw = nsfw_behaviour
@@ -264,75 +642,190 @@ class EngineManager(object):
 
         use_auth_token=self._token if engine.get("use_auth_token", False) else False
 
-        extra_kwargs={}
+        component_kwargs=dict(
+            use_auth_token=use_auth_token,
+            revision="fp16" if self.mode.fp16 else None,
+            dtype=torch.float16 if self.mode.fp16 else None
+        )
 
-        if self.mode.fp16:
-            extra_kwargs["revision"]="fp16"
-            extra_kwargs["torch_dtype"]=torch.float16
-
-        if self._nsfw == "flag":
-            extra_kwargs["safety_checker"]=FlagOnlySafetyChecker.from_pretrained(
-                weight_path, 
-                subfolder="safety_checker", 
-                use_auth_token=use_auth_token,
-                **extra_kwargs
-            )
+        component = lambda cls, subfolder: self._components.get(cls, weight_path, subfolder=subfolder, **component_kwargs)
+
+        safety_checker_class = FlagOnlySafetyChecker if self._nsfw == "flag" else StableDiffusionSafetyChecker
 
         if engine["class"] == "StableDiffusionPipeline":
-            return PipelineWrapper(
-                id=engine["id"],
-                mode=self._mode,
-                pipeline=StableDiffusionPipeline.from_pretrained(
-                    weight_path,
-                    use_auth_token=use_auth_token,
-                    **extra_kwargs                        
-                )
-            )
+            pipeline_class=StableDiffusionPipeline
+            vae=component(AutoencoderKL, "vae")
         elif engine["class"] == "UnifiedPipeline":
-            vae_extra_kwargs = {}
-            if self.mode.fp16: vae_extra_kwargs["torch_dtype"]=torch.float16
-            return PipelineWrapper(
-                id=engine["id"],
-                mode=self._mode,
-                pipeline=UnifiedPipeline.from_pretrained(
-                    weight_path, 
-                    use_auth_token=use_auth_token,
-                    vae=AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-ema", **vae_extra_kwargs),
-                    **extra_kwargs                        
-                )
+            pipeline_class=UnifiedPipeline
+            vae=self._components.get(AutoencoderKL, "stabilityai/sd-vae-ft-ema", dtype=component_kwargs["dtype"])
+        else:
+            return None
+
+        pipeline=pipeline_class(
+            vae=vae,
+            text_encoder=component(CLIPTextModel, "text_encoder"),
+            tokenizer=component(CLIPTokenizer, "tokenizer"),
+            unet=component(UNet2DConditionModel, "unet"),
+            safety_checker=component(safety_checker_class, "safety_checker"),
+            feature_extractor=component(CLIPFeatureExtractor, "feature_extractor"),
+            # Schedulers hold per-run state, so are never shared. PipelineWrapper picks the scheduler on each generate anyway
+            scheduler=PNDMScheduler(
+                beta_start=0.00085, 
+                beta_end=0.012, 
+                beta_schedule="scaled_linear",
+                num_train_timesteps=1000,
+                skip_prk_steps=True,
+                steps_offset=1
             )
-    
-    def loadPipelines(self):
+        )
+
+        if isinstance(pipeline, UnifiedPipeline): 
+            pipeline.text_embedding_cache = self._text_embedding_cache
+            pipeline.init_latent_cache = self._init_latent_cache
+            # Cache entries are keyed by weights rather than object, so they stay valid if the pipeline is rebuilt
+            pipeline.component_ids = dict(vae=self._components.componentId(vae), text_encoder=self._components.componentId(pipeline._text_encoder))
+
+        print(f"Built engine {engine['id']} ({len(self._components)} unique components loaded, {self._components.hits} shared)")
+
+        return PipelineWrapper(
+            id=engine["id"],
+            mode=self._mode,
+            pipeline=pipeline,
+            memory_model=self._memory_model
+        )
+
+    def _getEngine(self, id):
         for engine in self.engines:
-            if not engine.get("enabled", False): continue
+            if engine["id"] == id and engine.get("enabled", False): return engine
+        raise KeyError(id)
+
+    def loadPipeline(self, id):
+        """
+        Load a single engine if it isn't already loaded, and return it. If another thread is 
+        already loading the engine, this waits for that load to finish instead.
+        """
+        engine = self._getEngine(id)
 
+        with self._loadingLock:
+            if id in self._pipelines: return self._pipelines[id]
+
+            loaded = self._loading.get(id)
+            owner = loaded is None
+            if owner: loaded = self._loading[id] = threading.Event()
+
+        if not owner:
+            loaded.wait()
+            if id not in self._pipelines: raise Exception(f"Engine {id} failed to load")
+            return self._pipelines[id]
+
+        try:
+            print(f"Loading engine {id}")
             pipe=self.buildPipeline(engine)
 
-            if pipe:
-                self._pipelines[pipe.id] = pipe
-                if engine.get("default", False): self._default = pipe
-            else:
+            if not pipe: 
                 raise Exception(f'Unknown engine class "{engine["class"]}"')
 
-    def getStatus(self):
-        return {engine["id"]: engine["id"] in self._pipelines for engine in self.engines if engine.get("enabled", True)}
+            self._pipelines[pipe.id] = pipe
+            if engine.get("default", False): self._default = pipe
 
-    def getPipe(self, id):
+            return pipe
+        finally:
+            with self._loadingLock: del self._loading[id]
+            loaded.set()
+
+    def loadPipelines(self):
+        for engine in self.engines:
+            if not engine.get("enabled", False): continue
+            self.loadPipeline(engine["id"])
+
+    def prefetchPipelines(self):
         """
-        Get and activate a pipeline
-        TODO: Better activate / deactivate logic. Right now we just keep a max of one pipeline active.
+        Load engines in a background thread instead of up front. Engines with a `priority` are 
+        loaded in priority order (lowest first). Any other engine is loaded the first time it's used.
         """
+        engines = [engine for engine in self.engines if engine.get("enabled", False) and "priority" in engine]
+        engines.sort(key=lambda engine: engine["priority"])
+
+        def prefetch():
+            for engine in engines:
+                try:
+                    self.loadPipeline(engine["id"])
+                except Exception as e:
+                    print(f"Prefetching engine {engine['id']} failed: {e}")
+
+        threading.Thread(target=prefetch, name="EnginePrefetch", daemon=True).start()
+
+    def getStatus(self):
+        """Returns whether each enabled engine is loaded and ready to use"""
+        return {engine["id"]: engine["id"] in self._pipelines for engine in self.engines if engine.get("enabled", False)}
+
+    def getResidencyStats(self):
+        with self._residentLock:
+            return dict(
+                **vars(self._residency_stats),
+                resident=list(self._resident.keys()),
+                resident_bytes=self._residentSize(),
+                budget_bytes=self._memory_budget
+            )
+
+    def getCacheStats(self):
+        return dict(
+            text_embeddings=self._text_embedding_cache.getStats(),
+            init_latents=self._init_latent_cache.getStats()
+        )
+
+    def getMemoryStats(self):
+        """The learnt ratio of measured to predicted peak memory per engine, and the batch limits learnt from running out of memory"""
+        return self._memory_model.getStats()
 
-        # If we're already active, just return it
-        if self._active and id == self._active.id: return self._active
+    def _residentSize(self, *extra):
+        # Engines can share components, so count each module once
+        pipes = list(self._resident.values()) + list(extra)
+        return modules_memory_size([module for pipe in pipes for module in pipe.modules])
 
-        # Otherwise deactivate it
-        if self._active: self._active.deactivate()
+    def getPipe(self, id):
+        """
+        Get and activate a pipeline
 
-        self._active = self._pipelines[id]
-        self._active.activate()
+        Pipelines stay resident on the device after use while the total size of resident pipelines fits
+        in memory_budget (in bytes). When a pipeline needs activating and the budget would be exceeded, the
+        least recently used pipelines are deactivated first. With a budget of 0 only one pipeline is ever active.
 
-        return self._active
+        If the engine hasn't been loaded yet, it's loaded first.
+        """
+        if id not in self._pipelines: self.loadPipeline(id)
+
+        with self._residentLock:
+            # If we're already resident, just mark as most recently used and return it
+            if id in self._resident:
+                self._resident.move_to_end(id)
+                self._residency_stats.hits += 1
+                return self._resident[id]
+
+            pipe = self._pipelines[id]
+            self._residency_stats.misses += 1
+
+            # Otherwise make space for it by deactivating the least recently used pipelines
+            evicted_any = False
+            while self._resident and self._residentSize(pipe) > self._memory_budget:
+                _, evicted = self._resident.popitem(last=False)
+                evicted.deactivate()
+                evicted_any = True
+                self._residency_stats.evictions += 1
+                print(f"Deactivated {evicted.id} to make space for {id}")
+
+            # Deactivating a pipeline also moves any components it shares with other pipelines off the device,
+            # so put those back (this is a no-op for components that are already on the device)
+            if evicted_any:
+                for other in self._resident.values(): other.activate()
+
+            pipe.activate()
+            self._resident[id] = pipe
+
+            stats = self._residency_stats
+            print(f"Activated {id} (resident: {', '.join(self._resident.keys())}; hits {stats.hits}, misses {stats.misses}, evictions {stats.evictions})")
+
+            return pipe
             
 
 
@@ -0,0 +1,154 @@
+import threading
+from types import SimpleNamespace as SN
+
+from sdgrpcserver.pipeline.fastattention import CHUNKED_ATTENTION_BYTES
+
+def is_out_of_memory(error):
+    """Whether an exception is torch running out of device memory (CUDA and MPS both raise a RuntimeError saying so)"""
+    return isinstance(error, RuntimeError) and "out of memory" in str(error)
+
+class MemoryModel(object):
+    """
+    Predicts the peak device memory a generation needs, and picks the fastest settings that fit in the memory
+    available: attention slicing on or off and the slice size, how many images the VAE decodes at once (or tiled),
+    how many images go through the UNet at once, and (for tiled denoising) how many tiles.
+
+    The UNet and VAE never hold activations at the same time, so the peak is the larger of the two. Each has a
+    part that grows with the number of pixels worked on at once, and an attention score matrix (two copies,
+    the scores and their softmax) that grows with the square of the pixels in one image. For the UNet that is the
+    self attention on the largest feature map, one matrix per head per latent, unless attention is sliced, in
+    which case only slice_size of them exist at once. That only applies to the default attention backend - the
+    chunked backend never holds more than CHUNKED_ATTENTION_BYTES of scores, and the fused backends (sdpa and
+    xformers) don't hold the whole matrix at all, so for those slicing is never chosen.
+
+    The constants are a rough starting point. The ratio of measured to predicted peaks is learnt per engine (as
+    an exponential moving average, like CostModel) and every prediction is scaled by it.
+
+    It also remembers, per engine and resolution, the largest batch known to be safe after a batch has run out 
+    of memory, which caps the batch size whether the other settings are planned or fixed.
+    """
+
+    # Activation bytes per image pixel, per byte of element size, for each latent the UNet sees (two per image with guidance)
+    unet_bytes_per_pixel = 640
+    # Activation bytes per image pixel, per byte of element size, for the VAE decoder
+    vae_bytes_per_pixel = 1024
+    # The smallest and largest the learnt correction can get, so one odd measurement can't run away with it
+    factor_range = (0.5, 4.0)
+
+    def __init__(self, headroom=512 * 1024**2, smoothing=0.2):
+        self.headroom = headroom
+        self._smoothing = smoothing
+        self._factors = {}
+        self._batch_limits = {}
+        self._lock = threading.Lock()
+
+    def factor(self, engine_id):
+        with self._lock:
+            return self._factors.get(engine_id, 1.0)
+
+    def _attention(self, pixels, element_size, matrices):
+        tokens = pixels // 64
+        return 2 * matrices * tokens * tokens * element_size
+
+    def unetPeak(self, width, height, rows, heads, element_size, slice_size=None, guidance=True, attention_backend="default"):
+        """Predicted bytes of UNet activations to denoise `rows` images of width x height in one batch (uncorrected)"""
+        latents = rows * (2 if guidance else 1)
+        pixels = width * height
+        activations = latents * pixels * self.unet_bytes_per_pixel * element_size
+
+        if attention_backend == "default":
+            return activations + self._attention(pixels, element_size, slice_size if slice_size else latents * heads)
+        if attention_backend == "chunked":
+            return activations + min(self._attention(pixels, element_size, latents * heads), CHUNKED_ATTENTION_BYTES)
+        return activations
+
+    def vaePeak(self, width, height, rows, element_size):
+        """Predicted bytes of VAE activations to decode `rows` images of width x height at once (uncorrected)"""
+        pixels = width * height
+        return rows * pixels * self.vae_bytes_per_pixel * element_size + self._attention(pixels, element_size, 1)
+
+    def plan(self, engine_id, width, height, rows, heads, element_size, available, tile_size=None, tile_count=1, attention_backend="default"):
+        """
+        Choose settings for generating `rows` images of width x height with `available` bytes of device memory
+        (after weights). If tile_size is set the UNet is run over tile_count tiles of that size instead of the
+        whole image.
+
+        Returns a namespace of micro_batch_size, attention_slice (None for unsliced), vae_tile_pixels (None for
+        no limit), tile_batch_size and peak (the uncorrected prediction, to pass back to observe).
+        If nothing fits, returns the settings that need the least memory.
+        """
+        factor = self.factor(engine_id)
+        budget = max(available - self.headroom, 0)
+        fits = lambda peak: peak * factor <= budget
+
+        unet_width, unet_height = (min(tile_size, width), min(tile_size, height)) if tile_size else (width, height)
+
+        # In order of speed: the whole batch at once without slicing, then finer and finer slices, then smaller batches
+        slice_sizes = [None]
+        if attention_backend == "default": slice_sizes += [size for size in range(heads, 0, -1) if heads % size == 0]
+        batch_sizes = [rows]
+        while batch_sizes[-1] > 1: batch_sizes.append((batch_sizes[-1] + 1) // 2)
+
+        candidates = [(batch_size, slice_size) for batch_size in batch_sizes for slice_size in slice_sizes]
+        micro_batch_size, attention_slice = candidates[-1]
+        for batch_size, slice_size in candidates:
+            if fits(self.unetPeak(unet_width, unet_height, batch_size, heads, element_size, slice_size, attention_backend=attention_backend)):
+                micro_batch_size, attention_slice = batch_size, slice_size
+                break
+
+        unet_peak = self.unetPeak(unet_width, unet_height, micro_batch_size, heads, element_size, attention_slice, attention_backend=attention_backend)
+
+        # Tiles batch like extra rows, so fill each UNet call with as many as fit
+        tile_batch_size = None
+        if tile_size:
+            tile_batch_size = 1
+            while tile_batch_size < tile_count:
+                peak = self.unetPeak(unet_width, unet_height, micro_batch_size * (tile_batch_size + 1), heads, element_size, attention_slice, attention_backend=attention_backend)
+                if not fits(peak): break
+                tile_batch_size, unet_peak = tile_batch_size + 1, peak
+
+        # Decode the whole micro batch at once if it fits, otherwise as many images at a time as fit, otherwise in tiles
+        vae_rows = next((count for count in range(micro_batch_size, 0, -1) if fits(self.vaePeak(width, height, count, element_size))), 0)
+        if vae_rows == micro_batch_size: vae_tile_pixels = None
+        elif vae_rows: vae_tile_pixels = vae_rows * width * height
+        else: vae_tile_pixels = 512 * 512
+
+        vae_peak = self.vaePeak(width, height, vae_rows, element_size) if vae_rows else self.vaePeak(512, 512, 1, element_size)
+
+        return SN(
+            micro_batch_size=micro_batch_size,
+            attention_slice=attention_slice,
+            vae_tile_pixels=vae_tile_pixels,
+            tile_batch_size=tile_batch_size,
+            peak=max(unet_peak, vae_peak)
+        )
+
+    def observe(self, engine_id, predicted, measured):
+        """Update the model with the peak measured (in bytes, above the weights) for a run predicted to need `predicted`"""
+        if predicted <= 0 or measured <= 0: return
+
+        low, high = self.factor_range
+
+        with self._lock:
+            ratio = min(max(measured / predicted, low), high)
+            current = self._factors.get(engine_id)
+            if current is None: self._factors[engine_id] = ratio
+            else: self._factors[engine_id] = current + (ratio - current) * self._smoothing
+
+    def batchLimit(self, engine_id, width, height):
+        """The largest batch of width x height images known to be safe on an engine, or None if none has run out of memory"""
+        with self._lock:
+            return self._batch_limits.get((engine_id, width, height))
+
+    def limitBatch(self, engine_id, width, height, size):
+        """Record that batches of width x height images on an engine must be no bigger than size"""
+        with self._lock:
+            key = (engine_id, width, height)
+            self._batch_limits[key] = max(1, min(size, self._batch_limits.get(key, size)))
+
+    def getStats(self):
+        with self._lock:
+            return dict(
+                corrections=dict(self._factors),
+                batch_limits={f"{engine_id} {width}x{height}": size for (engine_id, width, height), size in self._batch_limits.items()}
+            )
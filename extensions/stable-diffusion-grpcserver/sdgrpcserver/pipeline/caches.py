@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+def tensor_bytes(value):
+    """The number of bytes used by a tensor, or by all the tensors in a (possibly nested) tuple, list or dict"""
+    if torch.is_tensor(value): return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)): return sum(tensor_bytes(item) for item in value)
+    if isinstance(value, dict): return sum(tensor_bytes(item) for item in value.values())
+    return 0
+
+class TensorLRUCache(object):
+    """
+    A thread-safe least-recently-used cache of tensors, bounded by the total bytes of the tensors it holds
+    rather than the number of entries. A max_bytes of 0 disables the cache.
+
+    Values are shared between every caller that gets them, so must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None if there isn't one"""
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = tensor_bytes(value)
+        if size > self.max_bytes: return
+
+        with self._lock:
+            if key in self._entries: self._bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def getStats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits, misses=self.misses, evictions=self.evictions,
+                entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes
+            )
+
+    def __len__(self):
+        return len(self._entries)
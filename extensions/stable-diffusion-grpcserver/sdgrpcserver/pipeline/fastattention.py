@@ -1,5 +1,8 @@
-from typing import Any, Optional
+import contextlib, contextvars
+from types import SimpleNamespace as SN
+from typing import Optional
 
+import torch
 from torch import nn
 
 try:
@@ -11,50 +14,167 @@ except:
 def has_xformers():
     return xformers is not None
 
-# From https://github.com/huggingface/diffusers/pull/532
+def has_sdpa():
+    return hasattr(nn.functional, "scaled_dot_product_attention")
+
+# The ways attention can be computed, by name. Each backend takes query, key and value of shape
+# (batch * heads, tokens, dim_head), an additive bias broadcastable to (batch * heads, query tokens, key tokens)
+# or None, the softmax scale and the attention slice size (which only the default backend uses)
+ATTENTION_BACKENDS = {}
+
+def register_attention_backend(name, available=lambda: True):
+    def register(function):
+        ATTENTION_BACKENDS[name] = SN(function=function, available=available)
+        return function
+    return register
+
+def available_attention_backends():
+    return [name for name, backend in ATTENTION_BACKENDS.items() if backend.available()]
+
+def best_attention_backend(device):
+    """The backend to use when none is asked for - xformers on CUDA if it's installed, otherwise PyTorch's fused attention if this version has it"""
+    if device == "cuda" and has_xformers(): return "xformers"
+    if has_sdpa(): return "sdpa"
+    return "default"
+
+# How many bytes of attention scores the chunked backend computes at once
+CHUNKED_ATTENTION_BYTES = 128 * 1024**2
+
+def _attention(query, key, value, bias, scale):
+    scores = torch.matmul(query, key.transpose(-1, -2)) * scale
+    if bias is not None: scores = scores + bias
+    return torch.matmul(scores.softmax(dim=-1), value)
+
+@register_attention_backend("default")
+def default_attention(query, key, value, bias, scale, slice_size=None):
+    """The diffusers attention - all the scores at once, or slice_size of the batch * heads at a time if attention slicing is on"""
+    if slice_size is None or slice_size >= query.shape[0]: return _attention(query, key, value, bias, scale)
+
+    out = torch.empty(query.shape[:2] + value.shape[2:], device=query.device, dtype=query.dtype)
+    for i in range(0, query.shape[0], slice_size):
+        slice_bias = bias[i:i+slice_size] if bias is not None and bias.shape[0] > 1 else bias
+        out[i:i+slice_size] = _attention(query[i:i+slice_size], key[i:i+slice_size], value[i:i+slice_size], slice_bias, scale)
+    return out
+
+@register_attention_backend("sdpa", available=has_sdpa)
+def sdpa_attention(query, key, value, bias, scale, slice_size=None):
+    """PyTorch's scaled_dot_product_attention, which uses a fused (flash or memory efficient) kernel where it can"""
+    # The default scale is dim_head ** -0.5, the same as CrossAttention's
+    return nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=bias)
+
+@register_attention_backend("chunked")
+def chunked_attention(query, key, value, bias, scale, slice_size=None):
+    """
+    Attention a chunk of query tokens at a time, sized so each chunk's scores take at most CHUNKED_ATTENTION_BYTES.
+    Every query token still attends to every key, so the result is exact, but memory no longer grows with the
+    square of the tokens. Works on any device, with any PyTorch.
+    """
+    tokens = query.shape[1]
+    chunk = max(1, CHUNKED_ATTENTION_BYTES // (query.shape[0] * key.shape[1] * query.element_size()))
+    if chunk >= tokens: return _attention(query, key, value, bias, scale)
+
+    out = torch.empty(query.shape[:2] + value.shape[2:], device=query.device, dtype=query.dtype)
+    for i in range(0, tokens, chunk):
+        chunk_bias = bias[:, i:i+chunk] if bias is not None and bias.shape[1] > 1 else bias
+        out[:, i:i+chunk] = _attention(query[:, i:i+chunk], key, value, chunk_bias, scale)
+    return out
+
+@register_attention_backend("xformers", available=has_xformers)
+def xformers_attention(query, key, value, bias, scale, slice_size=None):
+    """xformers' memory_efficient_attention. From https://github.com/huggingface/diffusers/pull/532"""
+    # xformers wants the bias as a full (batch * heads, query tokens, key tokens) tensor
+    if bias is not None: bias = bias.expand(query.shape[0], query.shape[1], key.shape[1]).contiguous()
+    return xformers.ops.memory_efficient_attention(query.contiguous(), key.contiguous(), value.contiguous(), attn_bias=bias)
+
+def mask_to_bias(mask, heads, dtype):
+    """
+    Turn a CrossAttention mask into an additive bias for the backends. A boolean mask is True where attention is
+    allowed (as in latent diffusion), any other mask is taken as a bias already. Masks are per batch item, either
+    over the key tokens (batch, key tokens) or over both (batch, query tokens, key tokens), and are repeated for
+    each head.
+    """
+    if mask.dtype == torch.bool:
+        # Not -inf, so a fully masked row gives an even spread rather than NaNs
+        bias = torch.zeros(mask.shape, device=mask.device, dtype=dtype).masked_fill(~mask, torch.finfo(dtype).min / 2)
+    else:
+        bias = mask.to(dtype)
+
+    if bias.dim() == 2: bias = bias[:, None, :]
+    return bias.repeat_interleave(heads, dim=0)
+
+# The attention slice size for the generation running in this thread, overriding each module's own (set by the
+# UNet's set_attention_slice). A context variable, so concurrent generations can each use their own
+_MODULE_SLICE_SIZE = object()
+_slice_size_override = contextvars.ContextVar("attention_slice_size", default=_MODULE_SLICE_SIZE)
+
+@contextlib.contextmanager
+def attention_slicing(slice_size):
+    """Run every BackendCrossAttention in this thread with the given slice size (None for unsliced) until exit"""
+    token = _slice_size_override.set(slice_size)
+    try:
+        yield
+    finally:
+        _slice_size_override.reset(token)
+
+class BackendCrossAttention(nn.Module):
+    """
+    A drop-in replacement for diffusers' CrossAttention (same weights), that computes the attention itself with
+    one of ATTENTION_BACKENDS. Set the backend with set_attention_backend. Attention slicing (set by the UNet's
+    set_attention_slice, or for one generation by attention_slicing) is still honoured by the default backend.
+    """
 
-class MemoryEfficientCrossAttention(nn.Module):
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.0):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = context_dim if context_dim is not None else query_dim
 
+        self.scale = dim_head ** -0.5
         self.heads = heads
         self.dim_head = dim_head
 
+        self.backend = "default"
+        self._slice_size = None
+
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
         self.to_v = nn.Linear(context_dim, inner_dim, bias=False)
 
         self.to_out = nn.Sequential(nn.Linear(inner_dim, query_dim), nn.Dropout(dropout))
-        self.attention_op: Optional[Any] = None
-
-    def forward(self, x, context=None, mask=None):
-        q = self.to_q(x)
-        context = context if context is not None else x
-        k = self.to_k(context)
-        v = self.to_v(context)
-
-        b, _, _ = q.shape
-        q, k, v = map(
-            lambda t: t.unsqueeze(3)
-            .reshape(b, t.shape[1], self.heads, self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b * self.heads, t.shape[1], self.dim_head)
-            .contiguous(),
-            (q, k, v),
-        )
-
-        # actually compute the attention, what we cannot get enough of
-        out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=self.attention_op)
-
-        # TODO: Use this directly in the attention operation, as a bias
-        if mask is not None:
-            raise NotImplementedError
-        out = (
-            out.unsqueeze(0)
-            .reshape(b, self.heads, out.shape[1], self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b, out.shape[1], self.heads * self.dim_head)
-        )
-        return self.to_out(out)
+
+    def _split_heads(self, tensor):
+        batch, tokens, _ = tensor.shape
+        return tensor.reshape(batch, tokens, self.heads, self.dim_head).permute(0, 2, 1, 3).reshape(batch * self.heads, tokens, self.dim_head)
+
+    def _merge_heads(self, tensor):
+        batch_heads, tokens, _ = tensor.shape
+        batch = batch_heads // self.heads
+        return tensor.reshape(batch, self.heads, tokens, self.dim_head).permute(0, 2, 1, 3).reshape(batch, tokens, self.heads * self.dim_head)
+
+    def forward(self, hidden_states, context=None, mask=None):
+        context = context if context is not None else hidden_states
+
+        query = self._split_heads(self.to_q(hidden_states))
+        key = self._split_heads(self.to_k(context))
+        value = self._split_heads(self.to_v(context))
+
+        bias = mask_to_bias(mask, self.heads, query.dtype) if mask is not None else None
+
+        slice_size = _slice_size_override.get()
+        if slice_size is _MODULE_SLICE_SIZE: slice_size = self._slice_size
+
+        out = ATTENTION_BACKENDS[self.backend].function(query, key, value, bias, self.scale, slice_size)
+        return self.to_out(self._merge_heads(out))
+
+def set_attention_backend(model: nn.Module, backend: Optional[str] = None, device="cuda"):
+    """Set the attention backend of every BackendCrossAttention in model (None for the best available on device)"""
+    if backend is None: backend = best_attention_backend(device)
+
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {backend}, expected one of {', '.join(ATTENTION_BACKENDS.keys())}")
+    if not ATTENTION_BACKENDS[backend].available():
+        raise ValueError(f"Attention backend {backend} isn't available here, use one of {', '.join(available_attention_backends())}")
+
+    for module in model.modules():
+        if isinstance(module, BackendCrossAttention): module.backend = backend
+
+    return backend
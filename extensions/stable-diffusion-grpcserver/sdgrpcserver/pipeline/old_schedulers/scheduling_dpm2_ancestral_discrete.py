@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 from typing import Optional, Tuple, Union
 
 import numpy as np
@@ -79,33 +80,11 @@ class DPM2AncestralDiscreteScheduler(OldSchedulerMixin, ConfigMixin):
         # setable values
         self.num_inference_steps = None
         self.timesteps = np.arange(0, num_train_timesteps)[::-1].copy()
-        self.derivatives = []
+        self.reset_state()
 
         self.tensor_format = tensor_format
         self.set_format(tensor_format=tensor_format)
 
-    def set_timesteps(self, num_inference_steps: int):
-        """
-        Sets the timesteps used for the diffusion chain. Supporting function to be run before inference.
-
-        Args:
-            num_inference_steps (`int`):
-                the number of diffusion steps used when generating samples with a pre-trained model.
-        """
-        self.num_inference_steps = num_inference_steps
-        self.timesteps = np.linspace(self.config.num_train_timesteps - 1, 0, num_inference_steps, dtype=float)
-
-        low_idx = np.floor(self.timesteps).astype(int)
-        high_idx = np.ceil(self.timesteps).astype(int)
-        frac = np.mod(self.timesteps, 1.0)
-        sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
-        sigmas = (1 - frac) * sigmas[low_idx] + frac * sigmas[high_idx]
-        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
-
-        self.derivatives = []
-
-        self.set_format(tensor_format=self.tensor_format)
-
     def step(
         self,
         model_output: Union[torch.FloatTensor, np.ndarray],
@@ -142,25 +121,24 @@ class DPM2AncestralDiscreteScheduler(OldSchedulerMixin, ConfigMixin):
         """
         if not noise_predictor: print("Noise predictor not provided, result will not be correct.")
 
-        sigma = self.sigmas[timestep]
+        sigma = self.host_sigmas[timestep]
         
         # 1. compute predicted original sample (x_0) from sigma-scaled predicted noise
         pred_original_sample = sample - sigma * model_output
         sigma_from = sigma
-        sigma_to = self.sigmas[timestep + 1]
+        sigma_to = self.host_sigmas[timestep + 1]
         sigma_up = (sigma_to ** 2 * (sigma_from ** 2 - sigma_to ** 2) / sigma_from ** 2) ** 0.5
         sigma_down = (sigma_to ** 2 - sigma_up ** 2) ** 0.5
 
         # 2. Convert to an ODE derivative
         derivative = (sample - pred_original_sample) / sigma
-        self.derivatives.append(derivative)
 
         if sigma_down == 0:
             dt = sigma_down - sigma
             sample = sample + derivative * dt
         else:
             # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
-            sigma_mid = sigma.log().lerp(sigma_down.log(), 0.5).exp()
+            sigma_mid = math.exp((math.log(sigma) + math.log(sigma_down)) / 2)
 
             dt_1 = sigma_mid - sigma
             dt_2 = sigma_down - sigma
@@ -174,7 +152,7 @@ class DPM2AncestralDiscreteScheduler(OldSchedulerMixin, ConfigMixin):
             
             derivative_2 = (sample_2 - pred_original_sample_2) / sigma_mid
             sample = sample + derivative_2 * dt_2
-            noise = torch.randn(sample.size(), dtype=sample.dtype, layout=sample.layout, device=generator.device, generator=generator).to(sample.device)
+            noise = self.randn_like(sample, generator=generator)
             sample = sample + noise * sigma_up
 
         prev_sample = sample
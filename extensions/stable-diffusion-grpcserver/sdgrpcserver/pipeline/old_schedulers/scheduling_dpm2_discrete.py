@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 from typing import Optional, Tuple, Union
 
 import numpy as np
@@ -79,33 +80,11 @@ class DPM2DiscreteScheduler(OldSchedulerMixin, ConfigMixin):
         # setable values
         self.num_inference_steps = None
         self.timesteps = np.arange(0, num_train_timesteps)[::-1].copy()
-        self.derivatives = []
+        self.reset_state()
 
         self.tensor_format = tensor_format
         self.set_format(tensor_format=tensor_format)
 
-    def set_timesteps(self, num_inference_steps: int):
-        """
-        Sets the timesteps used for the diffusion chain. Supporting function to be run before inference.
-
-        Args:
-            num_inference_steps (`int`):
-                the number of diffusion steps used when generating samples with a pre-trained model.
-        """
-        self.num_inference_steps = num_inference_steps
-        self.timesteps = np.linspace(self.config.num_train_timesteps - 1, 0, num_inference_steps, dtype=float)
-
-        low_idx = np.floor(self.timesteps).astype(int)
-        high_idx = np.ceil(self.timesteps).astype(int)
-        frac = np.mod(self.timesteps, 1.0)
-        sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
-        sigmas = (1 - frac) * sigmas[low_idx] + frac * sigmas[high_idx]
-        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
-
-        self.derivatives = []
-
-        self.set_format(tensor_format=self.tensor_format)
-
     def step(
         self,
         model_output: Union[torch.FloatTensor, np.ndarray],
@@ -142,9 +121,10 @@ class DPM2DiscreteScheduler(OldSchedulerMixin, ConfigMixin):
         """
         if not noise_predictor: print("Noise predictor not provided, result will not be correct.")
 
-        sigma = self.sigmas[timestep]
-        gamma = min(s_churn / (len(self.sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigma <= s_tmax else 0.
-        eps = torch.randn(sample.size(), dtype=sample.dtype, layout=sample.layout, device=generator.device, generator=generator).to(sample.device) * s_noise
+        sigma = self.host_sigmas[timestep]
+        sigma_next = self.host_sigmas[timestep + 1]
+        gamma = self.churn_gamma(sigma, s_churn, s_tmin, s_tmax)
+        eps = self.randn_like(sample, generator=generator) * s_noise
         sigma_hat = sigma * (gamma + 1)
         if gamma > 0:
             sample = sample + eps * (sigma_hat ** 2 - sigma ** 2) ** 0.5
@@ -153,16 +133,15 @@ class DPM2DiscreteScheduler(OldSchedulerMixin, ConfigMixin):
 
         # 2. Convert to an ODE derivative
         derivative = (sample - pred_original_sample) / sigma_hat
-        self.derivatives.append(derivative)
 
-        if self.sigmas[timestep + 1] == 0:
-            dt = self.sigmas[timestep + 1] - sigma_hat
+        if sigma_next == 0:
+            dt = sigma_next - sigma_hat
             sample = sample + derivative * dt
         else:
-            sigma_mid = sigma_hat.log().lerp(self.sigmas[timestep + 1].log(), 0.5).exp()
-            #sigma_mid = ((sigma_hat ** (1 / 3) + self.sigmas[timestep + 1] ** (1 / 3)) / 2) ** 3
+            sigma_mid = math.exp((math.log(sigma_hat) + math.log(sigma_next)) / 2)
+            #sigma_mid = ((sigma_hat ** (1 / 3) + sigma_next ** (1 / 3)) / 2) ** 3
             dt_1 = sigma_mid - sigma_hat
-            dt_2 = self.sigmas[timestep + 1] - sigma_hat
+            dt_2 = sigma_next - sigma_hat
             sample_2 = sample + derivative * dt_1
 
             if noise_predictor:
@@ -79,33 +79,11 @@ class EulerAncestralDiscreteScheduler(OldSchedulerMixin, ConfigMixin):
         # setable values
         self.num_inference_steps = None
         self.timesteps = np.arange(0, num_train_timesteps)[::-1].copy()
-        self.derivatives = []
+        self.reset_state()
 
         self.tensor_format = tensor_format
         self.set_format(tensor_format=tensor_format)
 
-    def set_timesteps(self, num_inference_steps: int):
-        """
-        Sets the timesteps used for the diffusion chain. Supporting function to be run before inference.
-
-        Args:
-            num_inference_steps (`int`):
-                the number of diffusion steps used when generating samples with a pre-trained model.
-        """
-        self.num_inference_steps = num_inference_steps
-        self.timesteps = np.linspace(self.config.num_train_timesteps - 1, 0, num_inference_steps, dtype=float)
-
-        low_idx = np.floor(self.timesteps).astype(int)
-        high_idx = np.ceil(self.timesteps).astype(int)
-        frac = np.mod(self.timesteps, 1.0)
-        sigmas = np.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
-        sigmas = (1 - frac) * sigmas[low_idx] + frac * sigmas[high_idx]
-        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
-
-        self.derivatives = []
-
-        self.set_format(tensor_format=self.tensor_format)
-
     def step(
         self,
         model_output: Union[torch.FloatTensor, np.ndarray],
@@ -131,23 +109,22 @@ class EulerAncestralDiscreteScheduler(OldSchedulerMixin, ConfigMixin):
             returning a tuple, the first element is the sample tensor.
 
         """
-        sigma = self.sigmas[timestep]
+        sigma = self.host_sigmas[timestep]
 
         # 1. compute predicted original sample (x_0) from sigma-scaled predicted noise
         pred_original_sample = sample - sigma * model_output
-        sigma_from = self.sigmas[timestep]
-        sigma_to = self.sigmas[timestep + 1]
+        sigma_from = sigma
+        sigma_to = self.host_sigmas[timestep + 1]
         sigma_up = (sigma_to ** 2 * (sigma_from ** 2 - sigma_to ** 2) / sigma_from ** 2) ** 0.5
         sigma_down = (sigma_to ** 2 - sigma_up ** 2) ** 0.5
         # 2. Convert to an ODE derivative
         derivative = (sample - pred_original_sample) / sigma
-        self.derivatives.append(derivative)
 
         dt = sigma_down - sigma
 
         prev_sample = sample + derivative * dt
 
-        noise = torch.randn(prev_sample.size(), dtype=prev_sample.dtype, layout=prev_sample.layout, device=generator.device, generator=generator).to(prev_sample.device)
+        noise = self.randn_like(prev_sample, generator=generator)
         prev_sample = prev_sample + noise * sigma_up
 
         if not return_dict:
@@ -11,15 +11,93 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import deque
 from dataclasses import dataclass
 from typing import Union
 
 import numpy as np
 import torch
 
+from sdgrpcserver.pipeline.randtools import batched_randn
+from sdgrpcserver.pipeline.caches import TensorLRUCache
+
 
 SCHEDULER_CONFIG_NAME = "scheduler_config.json"
 
+# Timestep and sigma tables, keyed by scheduler class, config, step count and device. Every scheduler
+# (and so every request and engine) with the same key shares the same tensors, so they must never be modified in place.
+# Each entry also has a host-side copy of the sigmas as python floats, so stepping never needs to read back from the device
+schedule_tables = TensorLRUCache(8 * 1024**2)
+
+def _config_key(config):
+    return tuple(sorted(
+        (key, value.tobytes() if isinstance(value, np.ndarray) else repr(value))
+        for key, value in config.items()
+    ))
+
+# The ways the sigmas can be spaced over a run. "default" spaces the timesteps evenly, "karras" uses the
+# rho = 7 spacing from Karras et al. (2022) https://arxiv.org/abs/2206.00364 and "exponential" spaces the
+# sigmas evenly in log space. Both of those spend more of the steps at low noise levels, where the fine detail
+# is resolved, so often need fewer steps for the same quality
+SIGMA_SCHEDULES = ("default", "karras", "exponential")
+
+def build_sigma_schedule(alphas_cumprod, num_inference_steps, sigma_schedule=None, rho=7.0):
+    """
+    Build the timesteps and sigmas (as numpy arrays) for a run of num_inference_steps with the given spacing
+    (one of SIGMA_SCHEDULES, None for the default). The sigmas have a final 0 appended, so are one longer than
+    the timesteps.
+
+    For the non-default spacings the sigmas run between the smallest and largest sigma the model was trained
+    on, and the (fractional) timesteps are found by interpolating in log sigma, so the UNet is always asked about
+    the noise level it is actually being given.
+    """
+    train_sigmas = np.array(((1 - alphas_cumprod) / alphas_cumprod) ** 0.5)
+
+    if sigma_schedule is None or sigma_schedule == "default":
+        timesteps = np.linspace(len(train_sigmas) - 1, 0, num_inference_steps, dtype=float)
+
+        low_idx = np.floor(timesteps).astype(int)
+        high_idx = np.ceil(timesteps).astype(int)
+        frac = np.mod(timesteps, 1.0)
+        sigmas = (1 - frac) * train_sigmas[low_idx] + frac * train_sigmas[high_idx]
+
+    else:
+        sigma_min, sigma_max = float(train_sigmas[0]), float(train_sigmas[-1])
+
+        if sigma_schedule == "karras":
+            ramp = np.linspace(0, 1, num_inference_steps)
+            min_inv_rho, max_inv_rho = sigma_min ** (1 / rho), sigma_max ** (1 / rho)
+            sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+        elif sigma_schedule == "exponential":
+            sigmas = np.exp(np.linspace(np.log(sigma_max), np.log(sigma_min), num_inference_steps))
+        else:
+            raise ValueError(f"Unknown sigma schedule {sigma_schedule}, expected one of {', '.join(SIGMA_SCHEDULES)}")
+
+        log_train_sigmas = np.log(train_sigmas.astype(np.float64))
+        timesteps = np.interp(np.log(sigmas), log_train_sigmas, np.arange(len(train_sigmas), dtype=float))
+
+    sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32)
+
+    return timesteps, sigmas
+
+class SamplerState(object):
+    """
+    The state a scheduler carries from one step of a run to the next. set_timesteps starts a fresh one.
+
+    history is a fixed-size ring of the last `depth` values the sampler pushed (derivatives, denoised 
+    predictions, ...), so memory use is bounded by how far back the method looks, not by the number of steps
+    """
+
+    def __init__(self, depth):
+        self.history = deque(maxlen=depth)
+
+    def push(self, value):
+        self.history.append(value)
+
+    def previous(self, n=1):
+        """The value pushed n pushes ago, or None if there isn't one yet"""
+        return self.history[-n] if 0 < n <= len(self.history) else None
+
 class OldSchedulerMixin:
     """
     Mixin containing common functions for the schedulers.
@@ -28,6 +106,13 @@ class OldSchedulerMixin:
     config_name = SCHEDULER_CONFIG_NAME
     ignore_for_config = ["tensor_format"]
 
+    # How many past values a step needs from SamplerState.history. The single step methods
+    # (Euler, Heun, DPM2) evaluate any extra points within the step, so need none
+    history_depth = 0
+
+    def reset_state(self):
+        self.state = SamplerState(self.history_depth)
+
     def set_format(self, tensor_format="pt"):
         self.tensor_format = tensor_format
         if tensor_format == "pt":
@@ -37,6 +122,53 @@ class OldSchedulerMixin:
 
         return self
 
+    def build_schedule(self, num_inference_steps, sigma_schedule=None):
+        """
+        Build the timesteps and sigmas (as numpy arrays) for a run of num_inference_steps. The sigmas have
+        a final 0 appended, so are one longer than the timesteps.
+        """
+        return build_sigma_schedule(self.alphas_cumprod, num_inference_steps, sigma_schedule)
+
+    def set_timesteps(self, num_inference_steps: int, device=None, sigma_schedule=None):
+        """
+        Sets the timesteps used for the diffusion chain. Supporting function to be run before inference.
+
+        The timestep and sigma tables are only built the first time a step count is used, and are then shared 
+        (already on the device) by every scheduler with the same config. `host_sigmas` holds the same sigmas as 
+        python floats, for the per-step scalar math and branching, so steps never synchronise with the device.
+
+        Args:
+            num_inference_steps (`int`):
+                the number of diffusion steps used when generating samples with a pre-trained model.
+            device (`str` or `torch.device`, optional):
+                the device the tables should be on. Defaults to the CPU.
+            sigma_schedule (`str`, optional):
+                how to space the sigmas - one of `SIGMA_SCHEDULES`. Defaults to evenly spaced timesteps.
+        """
+        self.num_inference_steps = num_inference_steps
+        self.reset_state()
+
+        if self.tensor_format != "pt":
+            self.timesteps, self.sigmas = self.build_schedule(num_inference_steps, sigma_schedule)
+            self.host_sigmas = tuple(self.sigmas.tolist())
+            return
+
+        device = torch.device(device if device is not None else "cpu")
+        key = (self.__class__, _config_key(self.config), num_inference_steps, sigma_schedule or "default", str(device))
+
+        tables = schedule_tables.get(key)
+        if tables is None:
+            timesteps, sigmas = self.build_schedule(num_inference_steps, sigma_schedule)
+            tables = (torch.from_numpy(timesteps).to(device), torch.from_numpy(sigmas).to(device), tuple(sigmas.tolist()))
+            schedule_tables.put(key, tables)
+
+        self.timesteps, self.sigmas, self.host_sigmas = tables
+
+    def churn_gamma(self, sigma, s_churn, s_tmin, s_tmax):
+        """The Karras et al. (2022) noise increase for a step at sigma (a python float, so this never touches the device)"""
+        if not (s_tmin <= sigma <= s_tmax): return 0.
+        return min(s_churn / (len(self.host_sigmas) - 1), 2 ** 0.5 - 1)
+
     def clip(self, tensor, min_value=None, max_value=None):
         tensor_format = getattr(self, "tensor_format", "pt")
 
@@ -93,8 +225,8 @@ class OldSchedulerMixin:
         if tensor_format == "np":
             return np.random.randn(*np.shape(tensor))
         elif tensor_format == "pt":
-            # return torch.randn_like(tensor)
-            return torch.randn(tensor.shape, layout=tensor.layout, generator=generator).to(tensor.device)
+            # randn_like does not support generator https://github.com/pytorch/pytorch/issues/27072
+            return batched_randn(tensor.shape, generator, tensor.device, dtype=tensor.dtype, layout=tensor.layout)
 
         raise ValueError(f"`self.tensor_format`: {self.tensor_format} is not valid.")
 
@@ -0,0 +1,59 @@
+import torch
+
+class LatentNoiseFactory(object):
+    """
+    Builds noise for a batch of latents where each row is drawn from it's own generator.
+
+    The noise a row gets only depends on that row's seed (and how much noise has already been drawn for it),
+    never on the batch size or the row's position in the batch, so a seed gives the same image whether
+    it is generated alone or batched with other requests.
+    """
+
+    def __init__(self, generators):
+        self.generators = list(generators)
+
+    @classmethod
+    def fromSeeds(cls, seeds, device):
+        """Build a factory with one generator per seed. Seeds <= 0 get a randomly seeded generator"""
+        generators = []
+        for seed in seeds:
+            generator = torch.Generator(device)
+            if seed > 0: generator.manual_seed(seed)
+            else: generator.seed()
+            generators.append(generator)
+
+        return cls(generators)
+
+    def __len__(self):
+        return len(self.generators)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice): return LatentNoiseFactory(self.generators[idx])
+        return self.generators[idx]
+
+    def __iter__(self):
+        return iter(self.generators)
+
+    def randn(self, shape, device, dtype=torch.float32, layout=torch.strided):
+        """Draw standard normal noise of shape (batch, ...), then move it to device"""
+        if len(self.generators) != shape[0]:
+            raise ValueError(f"Got {len(self.generators)} generators for a batch of {shape[0]}")
+
+        rows = [
+            torch.randn((1, *shape[1:]), generator=generator, device=generator.device, dtype=dtype, layout=layout).to(device)
+            for generator in self.generators
+        ]
+        return torch.cat(rows, dim=0)
+
+def batched_randn(shape, generator, device, dtype=torch.float32, layout=torch.strided):
+    """Draw standard normal noise of the given shape, then move it to device
+
+    generator can be a single torch.Generator (or None), in which case the whole batch is drawn from it,
+    or a LatentNoiseFactory (or a list of torch.Generator) with one entry per batch row, in which case
+    each row is drawn from its own generator
+    """
+    if isinstance(generator, (list, tuple)): generator = LatentNoiseFactory(generator)
+    if isinstance(generator, LatentNoiseFactory): return generator.randn(shape, device, dtype=dtype, layout=layout)
+
+    generator_device = generator.device if generator is not None else device
+    return torch.randn(shape, generator=generator, device=generator_device, dtype=dtype, layout=layout).to(device)
@@ -26,6 +26,8 @@ from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.utils import BaseOutput, deprecate
 from diffusers.schedulers.scheduling_utils import SchedulerMixin
 
+from sdgrpcserver.pipeline.randtools import batched_randn
+
 
 @dataclass
 class DDIMSchedulerOutput(BaseOutput):
@@ -285,7 +287,7 @@ class DDIMScheduler(SchedulerMixin, ConfigMixin):
         if eta > 0:
             # randn_like does not support generator https://github.com/pytorch/pytorch/issues/27072
             device = model_output.device if torch.is_tensor(model_output) else "cpu"
-            noise = torch.randn(model_output.shape, dtype=model_output.dtype, generator=generator, device=generator.device).to(device)
+            noise = batched_randn(model_output.shape, generator, device, dtype=model_output.dtype)
             variance = self._get_variance(timestep, prev_timestep) ** (0.5) * eta * noise
 
             prev_sample = prev_sample + variance
@@ -0,0 +1,111 @@
+import torch
+
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+# How many pixels neighbouring UNet tiles overlap (and blend) by
+TILE_OVERLAP = 128
+# UNet tiles must be a multiple of this many pixels (the latents are an eighth of the size, and the UNet halves them three times)
+TILE_MULTIPLE = 64
+
+def check_tile_size(tile_size, overlap=TILE_OVERLAP):
+    """Raise ValueError unless tile_size (in pixels) is a usable UNet tile size: a multiple of 64, and bigger than the overlap"""
+    if tile_size % TILE_MULTIPLE != 0 or tile_size <= overlap:
+        raise ValueError(f"Tile size must be a multiple of {TILE_MULTIPLE} pixels, and more than the {overlap} pixel overlap, but is {tile_size}")
+
+def tile_starts(length, tile, overlap):
+    """
+    Where to start each tile so that tiles of size `tile` cover `length`, overlapping by at least `overlap`.
+    The last tile is moved back to end exactly at `length`, so it may overlap it's neighbour by more.
+    """
+    if length <= tile: return [0]
+
+    stride = max(tile - overlap, 1)
+    starts = list(range(0, length - tile, stride))
+    return starts + [length - tile]
+
+def _ramp(size, overlap, ramp_start, ramp_end, device, dtype):
+    weights = torch.ones(size, device=device, dtype=dtype)
+    overlap = min(overlap, size // 2)
+    if overlap <= 0: return weights
+
+    # Never quite 0, so every pixel has some weight even where only one tile covers it
+    ramp = torch.arange(1, overlap + 1, device=device, dtype=dtype) / (overlap + 1)
+    if ramp_start: weights[:overlap] = ramp
+    if ramp_end: weights[-overlap:] = ramp.flip(0)
+
+    return weights
+
+def blend_window(height, width, overlap, top, left, bottom, right, device, dtype=torch.float32):
+    """
+    Blending weights of shape (1, 1, height, width) for a tile. The weights ramp up linearly over `overlap`
+    pixels on each edge that has a neighbouring tile (top, left, bottom and right say which do), and are 1
+    everywhere else, so overlapping tiles crossfade into each other instead of leaving a seam.
+    """
+    wy = _ramp(height, overlap, top, bottom, device, dtype)
+    wx = _ramp(width, overlap, left, right, device, dtype)
+    return (wy[:, None] * wx[None, :])[None, None]
+
+def tiles(height, width, tile, overlap):
+    """Yields (y, x, tile_height, tile_width, top, left, bottom, right) for each tile covering a height x width area"""
+    ys, xs = tile_starts(height, tile, overlap), tile_starts(width, tile, overlap)
+    tile_height, tile_width = min(tile, height), min(tile, width)
+
+    for yi, y in enumerate(ys):
+        for xi, x in enumerate(xs):
+            yield y, x, tile_height, tile_width, yi > 0, xi > 0, yi < len(ys) - 1, xi < len(xs) - 1
+
+def tiled_vae_decode(vae, latents, tile=64, overlap=16):
+    """
+    Decode latents with the VAE one overlapping tile (of `tile` latent pixels square) of one image at a time,
+    blending the decoded tiles together. Peak memory depends only on the tile size, not the image or batch size.
+    """
+    scale = 8
+    batch, _, height, width = latents.shape
+    result = None
+
+    for y, x, tile_height, tile_width, top, left, bottom, right in tiles(height, width, tile, overlap):
+        window = None
+
+        for row in range(batch):
+            decoded = vae.decode(latents[row:row+1, :, y:y+tile_height, x:x+tile_width]).sample
+
+            if result is None:
+                result = torch.zeros((batch, decoded.shape[1], height * scale, width * scale), device=decoded.device, dtype=decoded.dtype)
+                weights = torch.zeros((1, 1, height * scale, width * scale), device=decoded.device, dtype=decoded.dtype)
+
+            if window is None:
+                window = blend_window(tile_height * scale, tile_width * scale, overlap * scale, top, left, bottom, right, decoded.device, decoded.dtype)
+                weights[:, :, y*scale:(y+tile_height)*scale, x*scale:(x+tile_width)*scale] += window
+
+            result[row:row+1, :, y*scale:(y+tile_height)*scale, x*scale:(x+tile_width)*scale] += decoded * window
+
+    return result / weights
+
+def tiled_vae_encode(vae, images, tile=64, overlap=16):
+    """
+    Encode images with the VAE one overlapping tile (of `tile` latent pixels square, so 8 times that in image
+    pixels) of one image at a time, blending the latent distribution parameters (mean and logvar) of the tiles 
+    together. Returns a DiagonalGaussianDistribution, like `vae.encode(images).latent_dist`
+    """
+    scale = 8
+    batch, _, height, width = images.shape
+    height, width = height // scale, width // scale
+    result = None
+
+    for y, x, tile_height, tile_width, top, left, bottom, right in tiles(height, width, tile, overlap):
+        window = None
+
+        for row in range(batch):
+            parameters = vae.encode(images[row:row+1, :, y*scale:(y+tile_height)*scale, x*scale:(x+tile_width)*scale]).latent_dist.parameters
+
+            if result is None:
+                result = torch.zeros((batch, parameters.shape[1], height, width), device=parameters.device, dtype=parameters.dtype)
+                weights = torch.zeros((1, 1, height, width), device=parameters.device, dtype=parameters.dtype)
+
+            if window is None:
+                window = blend_window(tile_height, tile_width, overlap, top, left, bottom, right, parameters.device, parameters.dtype)
+                weights[:, :, y:y+tile_height, x:x+tile_width] += window
+
+            result[row:row+1, :, y:y+tile_height, x:x+tile_width] += parameters * window
+
+    return DiagonalGaussianDistribution(result / weights)
@@ -1,10 +1,13 @@
-import inspect, traceback
+import inspect, traceback, hashlib, math, contextlib
 import time
 from mimetypes import init
 from typing import Callable, List, Optional, Union
 
 import numpy as np
-from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin
+from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin, build_sigma_schedule
+from sdgrpcserver.pipeline.randtools import LatentNoiseFactory, batched_randn
+from sdgrpcserver.pipeline.tiling import TILE_OVERLAP, check_tile_size, tiles, blend_window, tiled_vae_decode, tiled_vae_encode
+from sdgrpcserver.pipeline.fastattention import attention_slicing
 import torch
 import torchvision
 import torchvision.transforms as T
@@ -15,6 +18,7 @@ from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 
 from diffusers.configuration_utils import FrozenDict
 from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from diffusers.models.vae import DiagonalGaussianDistribution
 from diffusers.pipeline_utils import DiffusionPipeline
 from diffusers.schedulers import LMSDiscreteScheduler
 from diffusers.schedulers.scheduling_utils import SchedulerMixin
@@ -37,14 +41,14 @@ class UnifiedMode(object):
 
 class Txt2imgMode(UnifiedMode):
 
-    def __init__(self, pipeline, generator, height, width, latents_dtype, batch_total, **kwargs):
+    def __init__(self, pipeline, scheduler, generator, height, width, latents_dtype, batch_total, **kwargs):
         if height % 8 != 0 or width % 8 != 0:
             raise ValueError(f"`height` and `width` have to be divisible by 8 but are {height} and {width}.")
 
         super().__init__(**kwargs)
 
         self.device = pipeline.device
-        self.scheduler = pipeline.scheduler
+        self.scheduler = scheduler
 
         self.generator = generator
 
@@ -61,7 +65,7 @@ class Txt2imgMode(UnifiedMode):
         # Unlike in other pipelines, latents need to be generated in the target device
         # for 1-to-1 results reproducibility with the CompVis implementation.
         # However this currently doesn't work in `mps`.
-        latents = torch.randn(
+        latents = batched_randn(
             self.latents_shape, 
             generator=self.generator, 
             device=self.latents_device, 
@@ -82,20 +86,21 @@ class Txt2imgMode(UnifiedMode):
 
 class Img2imgMode(UnifiedMode):
 
-    def __init__(self, pipeline, generator, init_image, latents_dtype, batch_total, num_inference_steps, strength, **kwargs):
+    def __init__(self, pipeline, scheduler, generator, init_image, latents_dtype, batch_total, num_inference_steps, strength, vae_tile_pixels="default", **kwargs):
         if strength < 0 or strength > 1:
             raise ValueError(f"The value of strength should in [0.0, 1.0] but is {strength}")
         
         super().__init__(**kwargs)
 
         self.device = pipeline.device
-        self.scheduler = pipeline.scheduler
+        self.scheduler = scheduler
         self.pipeline = pipeline
 
         self.generator = generator
 
         self.latents_dtype = latents_dtype
         self.batch_total = batch_total
+        self.vae_tile_pixels = vae_tile_pixels
         
         self.offset = self.scheduler.config.get("steps_offset", 0)
         self.init_timestep = int(num_inference_steps * strength) + self.offset
@@ -126,14 +131,44 @@ class Img2imgMode(UnifiedMode):
         # Done
         return tensor
 
-    def _buildInitialLatents(self):
+    def _encodeInitImage(self):
+        """
+        Get the VAE's latent distribution for the init image. If the pipeline has an init_latent_cache, the
+        distribution's parameters (mean and logvar) are cached by image content, so sampling the same init 
+        image again (with a different seed or strength) skips the VAE encoder
+        """
+        cache = self.pipeline.init_latent_cache
+
+        if cache is not None:
+            digest = hashlib.sha256(self.init_image.detach().cpu().contiguous().numpy().tobytes()).hexdigest()
+            # A tiled encode gives (slightly) different latents to a whole one, so they're cached separately
+            tiled = self.pipeline._tiles_encode(self.init_image.shape, self.vae_tile_pixels)
+            key = (self.pipeline.componentId("vae"), tiled, digest, tuple(self.init_image.shape), self.latents_dtype, str(self.device))
+
+            parameters = cache.get(key)
+            if parameters is not None: return DiagonalGaussianDistribution(parameters)
+
         init_image = self.init_image.to(device=self.device, dtype=self.latents_dtype)
-        init_latent_dist = self.pipeline.vae.encode(init_image).latent_dist
-        init_latents = init_latent_dist.sample(generator=self.generator)
-        init_latents = 0.18215 * init_latents
+        init_latent_dist = self.pipeline._encode_images(init_image, self.vae_tile_pixels)
 
-        # expand init_latents for batch_size
-        return torch.cat([init_latents] * self.batch_total, dim=0)
+        if cache is not None: cache.put(key, init_latent_dist.parameters)
+
+        return init_latent_dist
+
+    def _buildInitialLatents(self):
+        init_latent_dist = self._encodeInitImage()
+
+        if isinstance(self.generator, LatentNoiseFactory):
+            # Sample each row with it's own generator, so it matches what that row would get if generated alone
+            mean = torch.cat([init_latent_dist.mean] * self.batch_total, dim=0)
+            std = torch.cat([init_latent_dist.std] * self.batch_total, dim=0)
+            init_latents = mean + std * batched_randn(mean.shape, generator=self.generator, device=mean.device)
+        else:
+            init_latents = init_latent_dist.sample(generator=self.generator)
+            # expand init_latents for batch_size
+            init_latents = torch.cat([init_latents] * self.batch_total, dim=0)
+
+        return 0.18215 * init_latents
 
     def _getSchedulerNoiseTimestep(self, i, t = None):
         """Figure out the timestep to pass to scheduler.add_noise
@@ -155,7 +190,7 @@ class Img2imgMode(UnifiedMode):
         # NOTE: We run K_LMS in float32, because it seems to have problems with float16
         noise_dtype=torch.float32 if isinstance(self.scheduler, LMSDiscreteScheduler) else self.latents_dtype
 
-        self.image_noise = torch.randn(latents.shape, generator=self.generator, device=self.device, dtype=noise_dtype)
+        self.image_noise = batched_randn(latents.shape, generator=self.generator, device=self.device, dtype=noise_dtype)
         result = self.scheduler.add_noise(latents.to(noise_dtype), self.image_noise, self._getSchedulerNoiseTimestep(self.t_start))
         return result.to(self.latents_dtype) # Old schedulers return float32, and we force K_LMS into float32, but we need to return float16
 
@@ -280,6 +315,19 @@ class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
 
 
     def _fillWithShapedNoise(self, init_latents):
+        # The noise is shaped using statistics (and an FFT) over the whole tensor, so when each row has it's own
+        # generator, shape each row on it's own to keep the result independant of the rest of the batch
+        if isinstance(self.generator, LatentNoiseFactory):
+            return torch.cat([
+                self._fillRowsWithShapedNoise(init_latents[i:i+1], generator, slice(i, i+1))
+                for i, generator in enumerate(self.generator)
+            ], dim=0)
+
+        return self._fillRowsWithShapedNoise(init_latents, self.generator, slice(None))
+
+    def _fillRowsWithShapedNoise(self, init_latents, generator, rows):
+        mask, low_mask, high_mask = self.mask[rows], self.low_mask[rows], self.high_mask[rows]
+
         # HERE ARE ALL THE THINGS THAT GIVE BETTER OR WORSE RESULTS DEPENDING ON THE IMAGE:
         noise_mask_factor=1 # (1) How much to reduce noise during mask transition
         lmask_mode=3 # 3 (high_mask) seems consistently good. Options are 0 = none, 1 = low mask, 2 = mask as passed, 3 = high mask
@@ -303,28 +351,28 @@ class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
         masked_latents = init_latents
 
         if lmask_mode > 0:
-            latent_mask = self.low_mask if lmask_mode == 1 else self.mask if lmask_mode == 2 else self.high_mask
+            latent_mask = low_mask if lmask_mode == 1 else mask if lmask_mode == 2 else high_mask
             masked_latents = masked_latents * latent_mask
 
         # Generate some noise TODO: This might affect the seed?
         noise = torch.empty_like(masked_latents)
-        if noise_mode == 0 and noise_mode < 1: noise = noise.normal_(generator=self.generator, mean=masked_latents.mean(), std=masked_latents.std())
-        elif noise_mode == 1 and noise_mode < 2: noise = noise.cauchy_(generator=self.generator, median=masked_latents.median(), sigma=masked_latents.std())
+        if noise_mode == 0 and noise_mode < 1: noise = noise.normal_(generator=generator, mean=masked_latents.mean(), std=masked_latents.std())
+        elif noise_mode == 1 and noise_mode < 2: noise = noise.cauchy_(generator=generator, median=masked_latents.median(), sigma=masked_latents.std())
         elif noise_mode == 2: 
-            noise = noise.log_normal_(generator=self.generator)
+            noise = noise.log_normal_(generator=generator)
             noise = noise - noise.mean()
-        elif noise_mode == 3: noise = noise.normal_(generator=self.generator)
+        elif noise_mode == 3: noise = noise.normal_(generator=generator)
         elif noise_mode == 4: 
             if isinstance(self.scheduler, OldSchedulerMixin): 
                 targetSD = self.scheduler.sigmas[0]
             else:
                 targetSD = self.scheduler.init_noise_sigma
 
-            noise = noise.normal_(generator=self.generator, mean=0, std=targetSD)
+            noise = noise.normal_(generator=generator, mean=0, std=targetSD)
 
         # Make the noise less of a component of the convolution compared to the latent in the unmasked portion
         if nmask_mode > 0:
-            noise_mask = self.low_mask if nmask_mode == 1 else self.mask if nmask_mode == 2 else self.high_mask
+            noise_mask = low_mask if nmask_mode == 1 else mask if nmask_mode == 2 else high_mask
             noise = noise.mul(1-(noise_mask * noise_mask_factor))
 
         # Color the noise by the latent
@@ -338,7 +386,7 @@ class EnhancedInpaintMode(Img2imgMode, MaskProcessorMixin):
         else: noise = self._matchNorm(noise, masked_latents, cf=1)
 
         # And mix resulting noise into the black areas of the mask
-        return (init_latents * self.mask) + (noise * (1 - self.mask))
+        return (init_latents * mask) + (noise * (1 - mask))
 
     def generateLatents(self):
         # Build initial latents from init_image the same as for img2img
@@ -452,34 +500,111 @@ class DynamicModuleDiffusionPipeline(DiffusionPipeline):
 
 
 class NoisePredictor:
+    """
+    Runs the UNet for a step, with classifier free guidance if it's enabled.
 
-    def __init__(self, pipeline, text_embeddings, do_classifier_free_guidance, guidance_scale):
+    Guidance can be truncated to save UNet work late in the schedule, where it has little effect: once the step index
+    reaches `guidance_cutoff` (a fraction of num_inference_steps), or once the difference between the conditional 
+    and unconditional predictions drops below `guidance_cutoff_delta`, the unconditional half of the batch is 
+    dropped and the conditional prediction is used on it's own for the rest of the run.
+
+    If `tile_size` is set (in latent pixels), latents larger than that are denoised as overlapping tiles: the tiles 
+    of every row are cut out, run through the UNet together in batches of `tile_batch_size` tiles, and the noise 
+    predictions blended back together. Each tile is the size the model was trained at, so images much larger than 
+    that keep their detail, and memory scales with the tile batch rather than the image size.
+    """
+
+    def __init__(self, pipeline, scheduler, text_embeddings, do_classifier_free_guidance, guidance_scale, num_inference_steps=None, guidance_cutoff=None, guidance_cutoff_delta=None, tile_size=None, tile_overlap=16, tile_batch_size=None):
         self.pipeline = pipeline
+        self.scheduler = scheduler
         self.text_embeddings = text_embeddings
         self.do_classifier_free_guidance = do_classifier_free_guidance
+        # Either a single float, or a float32 tensor of shape (batch_total, 1, 1, 1) to give each batch row it's own scale.
+        # Rows with a scale of 1 or less aren't guided, so they get the same prediction as they would alone
         self.guidance_scale = guidance_scale
+        self.guided_rows = guidance_scale > 1.0 if torch.is_tensor(guidance_scale) else None
+
+        self.cutoff_index = None
+        if guidance_cutoff is not None and num_inference_steps: 
+            self.cutoff_index = math.ceil(guidance_cutoff * num_inference_steps)
+        self.cutoff_delta = guidance_cutoff_delta
+        # The step index guidance was truncated at, if it has been
+        self.truncated_at = None
+
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+
+    def _truncate(self, i):
+        self.truncated_at = i
+        self.do_classifier_free_guidance = False
+        # Keep just the conditional half of the embeddings
+        self.text_embeddings = self.text_embeddings.chunk(2)[1]
 
     def step(self, latents, i, t, sigma = None):
+        if self.do_classifier_free_guidance and self.cutoff_index is not None and i >= self.cutoff_index:
+            self._truncate(i)
+
         # expand the latents if we are doing classifier free guidance
         latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
 
-        if isinstance(self.pipeline.scheduler, OldSchedulerMixin): 
-            if not sigma: sigma = self.pipeline.scheduler.sigmas[i] 
+        if isinstance(self.scheduler, OldSchedulerMixin): 
+            # Use the host copy of the sigmas, so scaling the input doesn't need a device sync
+            if sigma is None: sigma = self.scheduler.host_sigmas[i]
             # the model input needs to be scaled to match the continuous ODE formulation in K-LMS
             latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
         else:
-            latent_model_input = self.pipeline.scheduler.scale_model_input(latent_model_input, t)
+            latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
         # predict the noise residual
-        noise_pred = self.pipeline.unet(latent_model_input, t, encoder_hidden_states=self.text_embeddings).sample
+        if self.tile_size and max(latent_model_input.shape[2:]) > self.tile_size:
+            noise_pred = self._tiledUnet(latent_model_input, t)
+        else:
+            noise_pred = self.pipeline.unet(latent_model_input, t, encoder_hidden_states=self.text_embeddings).sample
 
         # perform guidance
         if self.do_classifier_free_guidance:
             noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-            noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
+            # Scaled in float32 and rounded once to the prediction's dtype, the same as multiplying by a plain float does
+            guidance = (noise_pred_text - noise_pred_uncond) * self.guidance_scale
+            noise_pred = noise_pred_uncond + guidance.to(noise_pred_text.dtype)
+            if self.guided_rows is not None: noise_pred = torch.where(self.guided_rows, noise_pred, noise_pred_text)
+
+            # Checking the delta needs to read it back from the device, so this costs a sync per step until it triggers.
+            # Uses the largest delta of any guided row, so guidance is only dropped once every row has converged
+            if self.cutoff_delta is not None:
+                delta = (noise_pred_text - noise_pred_uncond).abs().flatten(1).mean(dim=1)
+                if self.guided_rows is not None: delta = delta * self.guided_rows.flatten()
+                if delta.max().item() < self.cutoff_delta: self._truncate(i + 1)
 
         return noise_pred
 
+    def _tiledUnet(self, latent_model_input, t):
+        _, _, height, width = latent_model_input.shape
+        regions = list(tiles(height, width, self.tile_size, self.tile_overlap))
+        tile_batch_size = self.tile_batch_size or len(regions)
+
+        noise_pred, weights = None, None
+
+        for start in range(0, len(regions), tile_batch_size):
+            chunk = regions[start:start+tile_batch_size]
+
+            # Every tile is the same size, so the tiles (each with every row of the batch) can go through the UNet together
+            tile_input = torch.cat([latent_model_input[:, :, y:y+h, x:x+w] for y, x, h, w, *_ in chunk])
+            tile_embeddings = self.text_embeddings.repeat(len(chunk), 1, 1)
+            tile_preds = self.pipeline.unet(tile_input, t, encoder_hidden_states=tile_embeddings).sample.chunk(len(chunk))
+
+            if noise_pred is None:
+                noise_pred = torch.zeros((latent_model_input.shape[0], tile_preds[0].shape[1], height, width), device=tile_input.device, dtype=tile_preds[0].dtype)
+                weights = torch.zeros((1, 1, height, width), device=tile_input.device, dtype=tile_preds[0].dtype)
+
+            for (y, x, h, w, top, left, bottom, right), tile_pred in zip(chunk, tile_preds):
+                window = blend_window(h, w, self.tile_overlap, top, left, bottom, right, tile_input.device, tile_pred.dtype)
+                noise_pred[:, :, y:y+h, x:x+w] += tile_pred * window
+                weights[:, :, y:y+h, x:x+w] += window
+
+        return noise_pred / weights
+
 class UnifiedPipeline(DynamicModuleDiffusionPipeline):
     r"""
     Pipeline for unified image generation using Stable Diffusion.
@@ -545,6 +670,72 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
             feature_extractor=feature_extractor,
         )
 
+        # TensorLRUCaches of text embeddings and VAE-encoded init images, shared with other pipelines. Set by the engine manager
+        self.text_embedding_cache = None
+        self.init_latent_cache = None
+        # Stable identifiers of the weights of each module (by name), for the cache keys. Set by the engine manager
+        self.component_ids = {}
+
+        # The most pixels the VAE encodes or decodes in one go, or None for no limit. See enable_vae_tiling
+        self.vae_tile_pixels = None
+
+    def enable_vae_tiling(self, max_pixels: Optional[int] = 1024 * 1024):
+        r"""
+        Enable tiled VAE encoding and decoding.
+
+        The VAE's peak memory grows with the number of pixels it works on at once, and at large sizes is more than the
+        UNet needs. With tiling enabled, a batch of more than `max_pixels` is decoded a few images at a time, and any
+        single image of more than `max_pixels` is encoded or decoded as overlapping tiles that are blended together, 
+        so peak memory is bounded whatever the size of the image or batch. Smaller batches are unaffected.
+
+        Args:
+            max_pixels (`int`, *optional*, defaults to 1024x1024):
+                The most (image) pixels to pass through the VAE at once. `None` disables tiling.
+        """
+        self.vae_tile_pixels = max_pixels
+
+    def disable_vae_tiling(self):
+        r"""
+        Disable tiled VAE encoding and decoding, so the VAE always works on the whole batch at once.
+        """
+        self.enable_vae_tiling(None)
+
+    def _decode_latents(self, latents, max_pixels="default"):
+        if max_pixels == "default": max_pixels = self.vae_tile_pixels
+        batch, _, height, width = latents.shape
+        pixels = height * width * 64
+
+        if max_pixels is None or batch * pixels <= max_pixels: return self.vae.decode(latents).sample
+
+        if pixels > max_pixels:
+            print(f"Decoding {batch} latents of {width * 8}x{height * 8} in tiles")
+            return tiled_vae_decode(self.vae, latents)
+
+        # Each image fits on it's own, so just decode as many images at a time as fit
+        rows = max_pixels // pixels
+        return torch.cat([self.vae.decode(latents[i:i+rows]).sample for i in range(0, batch, rows)])
+
+    def componentId(self, name):
+        """
+        An identifier for the weights of a module, for cache keys. Modules loaded by the engine manager have one 
+        that is stable across pipelines being unloaded and rebuilt, others fall back to the module's id
+        """
+        return self.component_ids.get(name) or ("id", name, id(getattr(self, "_" + name)))
+
+    def _tiles_encode(self, shape, max_pixels="default"):
+        """Whether _encode_images would encode images of this (batch, channels, height, width) shape in tiles"""
+        if max_pixels == "default": max_pixels = self.vae_tile_pixels
+        batch, _, height, width = shape
+        return max_pixels is not None and batch * height * width > max_pixels
+
+    def _encode_images(self, images, max_pixels="default"):
+        """Encode images with the VAE, tiled if they are too big. Returns the latent distribution"""
+        if not self._tiles_encode(images.shape, max_pixels): return self.vae.encode(images).latent_dist
+
+        batch, _, height, width = images.shape
+        print(f"Encoding {batch} images of {width}x{height} in tiles")
+        return tiled_vae_encode(self.vae, images)
+
     def enable_attention_slicing(self, slice_size: Optional[Union[str, int]] = "auto"):
         r"""
         Enable sliced attention computation.
@@ -572,6 +763,37 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         # set slice_size = `None` to disable `attention slicing`
         self.enable_attention_slicing(None)
 
+    def _encode_input_ids(self, input_ids):
+        """
+        Run the text encoder over input_ids, but only once for each distinct prompt in the batch
+
+        If text_embedding_cache is set, prompts that have been encoded before are taken from the cache, and the 
+        text encoder is only used (and so, in module_mode "one", only moved to the device) if any prompt is new
+        """
+        unique_ids, inverse = torch.unique(input_ids, dim=0, return_inverse=True)
+
+        cache = self.text_embedding_cache
+        if cache is None:
+            embeddings = self.text_encoder(unique_ids.to(self.device))[0]
+            return embeddings[inverse.to(embeddings.device)]
+
+        # Use the private attribute so we don't move the encoder just to build the key
+        encoder = self._text_encoder
+        keys = [(self.componentId("text_encoder"), tuple(row.tolist()), encoder.dtype, str(self.device)) for row in unique_ids]
+
+        rows = [cache.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+
+        if missing:
+            encoded = self.text_encoder(unique_ids[missing].to(self.device))[0]
+            for i, row in zip(missing, encoded):
+                # Clone so the cache entry doesn't keep the whole batch's storage alive
+                rows[i] = row.clone()
+                cache.put(keys[i], rows[i])
+
+        embeddings = torch.stack(rows)
+        return embeddings[inverse.to(embeddings.device)]
+
     @torch.no_grad()
     def __call__(
         self,
@@ -583,17 +805,27 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         outmask_image: Union[torch.FloatTensor, PIL.Image.Image] = None,
         strength: float = 0.0,
         num_inference_steps: int = 50,
-        guidance_scale: float = 7.5,
+        sigma_schedule: Optional[str] = None,
+        guidance_scale: Union[float, List[float]] = 7.5,
+        guidance_cutoff: Optional[float] = None,
+        guidance_cutoff_delta: Optional[float] = None,
+        tile_size: Optional[int] = None,
+        tile_overlap: int = TILE_OVERLAP,
+        tile_batch_size: Optional[int] = None,
+        attention_slice: Optional[Union[str, int]] = "default",
+        vae_tile_pixels: Optional[Union[str, int]] = "default",
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_images_per_prompt: Optional[int] = 1,
         eta: Optional[float] = 0.0,
-        generator: Optional[torch.Generator] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator], LatentNoiseFactory]] = None,
         latents: Optional[torch.FloatTensor] = None,
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
         run_safety_checker: bool = True,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[int] = 1,
+        scheduler: Optional[SchedulerMixin] = None,
+        progress_bar: Optional[Callable] = None,
         **kwargs,
     ):
         r"""
@@ -609,12 +841,38 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
             num_inference_steps (`int`, *optional*, defaults to 50):
                 The number of denoising steps. More denoising steps usually lead to a higher quality image at the
                 expense of slower inference.
+            sigma_schedule (`str`, *optional*):
+                How to space the noise levels over the steps - `"default"`, `"karras"` or `"exponential"`. Only
+                applies to the K-diffusion style schedulers (including [`schedulers.LMSDiscreteScheduler`]), will be
+                ignored for others.
             guidance_scale (`float`, *optional*, defaults to 7.5):
                 Guidance scale as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
                 `guidance_scale` is defined as `w` of equation 2. of [Imagen
                 Paper](https://arxiv.org/pdf/2205.11487.pdf). Guidance scale is enabled by setting `guidance_scale >
                 1`. Higher guidance scale encourages to generate images that are closely linked to the text `prompt`,
-                usually at the expense of lower image quality.
+                usually at the expense of lower image quality. Can also be a list with one scale per generated image.
+            guidance_cutoff (`float`, *optional*):
+                Truncated guidance. Once this fraction of the `num_inference_steps` has passed, stop running the
+                unconditional half of the batch and use the conditional prediction on it's own, which roughly halves
+                the UNet work for the remaining steps. Defaults to guiding every step.
+            guidance_cutoff_delta (`float`, *optional*):
+                Truncated guidance. Stop guiding once the mean absolute difference between the conditional and
+                unconditional noise predictions drops below this, for every image in the batch.
+            tile_size (`int`, *optional*):
+                Tiled denoising, for images much larger than the model was trained on. If the image is wider or
+                taller than this many pixels (a multiple of 64 bigger than `tile_overlap`, usually 512), the UNet is
+                run on overlapping tiles of this size, and the noise predictions blended together. Works with txt2img,
+                img2img and inpainting.
+            tile_overlap (`int`, *optional*, defaults to 128):
+                How many pixels neighbouring tiles overlap (and blend) by.
+            tile_batch_size (`int`, *optional*):
+                How many tiles to run through the UNet at once. Defaults to all of them.
+            attention_slice (`int`, *optional*, defaults to `"default"`):
+                The attention slice size for this call only (`None` for unsliced), without changing the pipeline's,
+                so concurrent calls can each use their own. `"default"` uses the one set by `enable_attention_slicing`.
+            vae_tile_pixels (`int`, *optional*, defaults to `"default"`):
+                The most pixels to pass through the VAE at once for this call only (`None` for no limit), without 
+                changing the pipeline's. `"default"` uses the one set by `enable_vae_tiling`.
             negative_prompt (`str` or `List[str]`, *optional*):
                 The prompt or prompts not to guide the image generation. Ignored when not using guidance (i.e., ignored
                 if `guidance_scale` is less than `1`).
@@ -623,9 +881,11 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
             eta (`float`, *optional*, defaults to 0.0):
                 Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
                 [`schedulers.DDIMScheduler`], will be ignored for others.
-            generator (`torch.Generator`, *optional*):
+            generator (`torch.Generator`, `List[torch.Generator]` or `LatentNoiseFactory`, *optional*):
                 A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
-                deterministic.
+                deterministic. Can also be a list of generators or a `LatentNoiseFactory` with one generator per
+                generated image, so that each image only depends on it's own generator and not on the other images
+                in the batch.
             latents (`torch.FloatTensor`, *optional*):
                 Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
@@ -642,6 +902,11 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            scheduler (`SchedulerMixin`, *optional*):
+                A scheduler to use for this call only, instead of `self.scheduler`. The scheduler holds state for
+                the run, so concurrent calls should each pass their own.
+            progress_bar (`Callable`, *optional*):
+                A function to wrap the timestep iterator with for this call only, instead of `self.progress_bar`.
 
         Returns:
             [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -672,8 +937,23 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         if (outmask_image != None and init_image == None):
             raise ValueError(f"Can't pass a outmask without an image")
 
-        # set timesteps
-        self.scheduler.set_timesteps(num_inference_steps)
+        # Use the scheduler and progress bar for this call if passed, so concurrent calls don't share state
+        if scheduler is None: scheduler = self.scheduler
+        if progress_bar is None: progress_bar = self.progress_bar
+
+        # set timesteps (on the device, for schedulers that support it)
+        if isinstance(scheduler, OldSchedulerMixin):
+            scheduler.set_timesteps(num_inference_steps, device=self.device, sigma_schedule=sigma_schedule)
+        elif "device" in inspect.signature(scheduler.set_timesteps).parameters:
+            scheduler.set_timesteps(num_inference_steps, device=self.device)
+        else:
+            scheduler.set_timesteps(num_inference_steps)
+
+        # K-LMS steps through whatever sigmas it holds, so the other spacings can just replace its tables
+        if sigma_schedule and isinstance(scheduler, LMSDiscreteScheduler):
+            timesteps, sigmas = build_sigma_schedule(scheduler.alphas_cumprod, num_inference_steps, sigma_schedule)
+            scheduler.timesteps = torch.from_numpy(timesteps).to(scheduler.timesteps.device)
+            scheduler.sigmas = torch.from_numpy(sigmas).to(scheduler.sigmas.device)
 
         # get prompt text embeddings
         text_inputs = self.tokenizer(
@@ -691,15 +971,33 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
                 f" {self.tokenizer.model_max_length} tokens: {removed_text}"
             )
             text_input_ids = text_input_ids[:, : self.tokenizer.model_max_length]
-        text_embeddings = self.text_encoder(text_input_ids.to(self.device))[0]
+        text_embeddings = self._encode_input_ids(text_input_ids)
 
         # duplicate text embeddings for each generation per prompt
         text_embeddings = text_embeddings.repeat_interleave(num_images_per_prompt, dim=0)
 
+        batch_total = batch_size * num_images_per_prompt
+
+        if isinstance(generator, list): generator = LatentNoiseFactory(generator)
+
+        if tile_size: check_tile_size(tile_size, tile_overlap)
+
+        if isinstance(generator, LatentNoiseFactory) and len(generator) != batch_total:
+            raise ValueError(f"Got {len(generator)} generators, but generating {batch_total} images")
+
+        if isinstance(guidance_scale, list) and len(guidance_scale) != batch_total:
+            raise ValueError(f"Got {len(guidance_scale)} guidance scales, but generating {batch_total} images")
+
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
         # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = guidance_scale > 1.0
+        if isinstance(guidance_scale, list):
+            # In a mixed batch, the rows that wouldn't be guided on their own get exactly 1
+            guidance_scale = [max(scale, 1.0) for scale in guidance_scale]
+            do_classifier_free_guidance = max(guidance_scale) > 1.0
+        else:
+            do_classifier_free_guidance = guidance_scale > 1.0
+
         # get unconditional embeddings for classifier free guidance
         if do_classifier_free_guidance:
             uncond_tokens: List[str]
@@ -729,10 +1027,11 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
                 truncation=True,
                 return_tensors="pt",
             )
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
+            uncond_embeddings = self._encode_input_ids(uncond_input.input_ids)
 
             # duplicate unconditional embeddings for each generation per prompt
-            uncond_embeddings = uncond_embeddings.repeat_interleave(batch_size * num_images_per_prompt, dim=0)
+            # (there's either a single negative prompt, or one per prompt)
+            uncond_embeddings = uncond_embeddings.repeat_interleave(batch_total // uncond_embeddings.shape[0], dim=0)
 
             # For classifier free guidance, we need to do two forward passes.
             # Here we concatenate the unconditional and text embeddings into a single batch
@@ -741,8 +1040,12 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
 
         # Calculate operating mode based on arguments
         latents_dtype = text_embeddings.dtype
-        batch_total = batch_size * num_images_per_prompt
 
+        # Per row scales are kept in float32 (not rounded to fp16), so each row is guided exactly as it would be alone.
+        # If every row has the same scale, the plain float is used, just like a single image
+        if isinstance(guidance_scale, list):
+            if len(set(guidance_scale)) == 1: guidance_scale = guidance_scale[0]
+            else: guidance_scale = torch.tensor(guidance_scale, device=self.device, dtype=torch.float32)[:, None, None, None]
 
         if mask_image != None: mode_class = EnhancedInpaintMode
         elif init_image != None: mode_class = Img2imgMode
@@ -750,13 +1053,15 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
 
         mode = mode_class(
             pipeline=self, 
+            scheduler=scheduler,
             generator=generator,
             width=width, height=height,
             init_image=init_image, mask_image=mask_image,
             latents_dtype=latents_dtype,
             batch_total=batch_total,
             num_inference_steps=num_inference_steps,
-            strength=strength
+            strength=strength,
+            vae_tile_pixels=vae_tile_pixels
         ) 
 
         print(f"Mode {mode.__class__} with strength {strength}")
@@ -765,8 +1070,12 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         # passed into a scheduler if they need to re-call
         noise_predictor = NoisePredictor(
             pipeline=self, 
+            scheduler=scheduler,
             text_embeddings=text_embeddings, 
-            do_classifier_free_guidance=do_classifier_free_guidance, guidance_scale=guidance_scale
+            do_classifier_free_guidance=do_classifier_free_guidance, guidance_scale=guidance_scale,
+            num_inference_steps=num_inference_steps,
+            guidance_cutoff=guidance_cutoff, guidance_cutoff_delta=guidance_cutoff_delta,
+            tile_size=tile_size // 8 if tile_size else None, tile_overlap=tile_overlap // 8, tile_batch_size=tile_batch_size
         )
 
         # Get the initial starting point - either pure random noise, or the source image with some noise depending on mode
@@ -776,9 +1085,9 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
-        accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
-        accepts_generator = "generator" in set(inspect.signature(self.scheduler.step).parameters.keys())
-        accepts_noise_predictor = "noise_predictor" in set(inspect.signature(self.scheduler.step).parameters.keys())
+        accepts_eta = "eta" in set(inspect.signature(scheduler.step).parameters.keys())
+        accepts_generator = "generator" in set(inspect.signature(scheduler.step).parameters.keys())
+        accepts_noise_predictor = "noise_predictor" in set(inspect.signature(scheduler.step).parameters.keys())
 
         extra_step_kwargs = {}
         if accepts_eta: extra_step_kwargs["eta"] = eta
@@ -787,38 +1096,45 @@ class UnifiedPipeline(DynamicModuleDiffusionPipeline):
 
         t_start = mode.t_start
 
-        timesteps_tensor = self.scheduler.timesteps[t_start:].to(self.device)
+        timesteps_tensor = scheduler.timesteps[t_start:].to(self.device)
 
-        for i, t in enumerate(self.progress_bar(timesteps_tensor)):
-            t_index = t_start + i
+        # Slicing applies to every UNet call in the loop (including any the scheduler makes through the noise predictor)
+        slicing = attention_slicing(attention_slice) if attention_slice != "default" else contextlib.nullcontext()
 
-            # predict the noise residual
-            noise_pred = noise_predictor.step(latents, t_index, t)
+        with slicing:
+            for i, t in enumerate(progress_bar(timesteps_tensor)):
+                t_index = t_start + i
 
-            # compute the previous noisy sample x_t -> x_t-1
+                # predict the noise residual
+                noise_pred = noise_predictor.step(latents, t_index, t)
 
-            if isinstance(self.scheduler, OldSchedulerMixin): 
-                latents = self.scheduler.step(noise_pred, t_index, latents, **extra_step_kwargs).prev_sample
-            else:
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+                # compute the previous noisy sample x_t -> x_t-1
+
+                if isinstance(scheduler, OldSchedulerMixin): 
+                    latents = scheduler.step(noise_pred, t_index, latents, **extra_step_kwargs).prev_sample
+                else:
+                    latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+
+                latents = mode.latentStep(latents, t_index, t, i / (timesteps_tensor.shape[0] + 1))
 
-            latents = mode.latentStep(latents, t_index, t, i / (timesteps_tensor.shape[0] + 1))
+                # call the callback, if provided
+                if callback is not None and i % callback_steps == 0:
+                    callback(i, t, latents)
 
-            # call the callback, if provided
-            if callback is not None and i % callback_steps == 0:
-                callback(i, t, latents)
+        if noise_predictor.truncated_at is not None:
+            print(f"Guidance truncated at step {noise_predictor.truncated_at} of {num_inference_steps}")
 
         latents = 1 / 0.18215 * latents
-        image = self.vae.decode(latents).sample
+        image = self._decode_latents(latents, vae_tile_pixels)
 
         image = (image / 2 + 0.5).clamp(0, 1)
 
         if strength <= 1 and outmask_image != None:
-            outmask = torch.cat([outmask_image] * batch_size)
+            outmask = torch.cat([outmask_image] * batch_total)
             outmask = outmask[:, [0,1,2]]
             outmask = outmask.to(self.device)
 
-            source =  torch.cat([init_image] * batch_size)
+            source =  torch.cat([init_image] * batch_total)
             source = source[:, [0,1,2]]
             source = source.to(self.device)
 
@@ -26,6 +26,8 @@ sys.path.append(generatedPath)
 import generation_pb2_grpc, dashboard_pb2_grpc, engines_pb2_grpc
 
 from sdgrpcserver.manager import EngineMode, EngineManager
+from sdgrpcserver.pipeline.fastattention import available_attention_backends
+from sdgrpcserver.batcher import GenerationBatcher
 from sdgrpcserver.services.dashboard import DashboardServiceServicer
 from sdgrpcserver.services.generate import GenerationServiceServicer
 from sdgrpcserver.services.engines import EnginesServiceServicer
@@ -83,7 +85,10 @@ class GrpcServer(object):
         interceptors = []        
         if args.access_token: interceptors.append(GrpcServerTokenChecker(args.access_token))
 
-        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=interceptors)
+        # Generate requests block their worker while queued, so we need enough workers for a full queue plus some spare
+        max_workers = (args.max_queue_length or 28) + 4
+
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers), interceptors=interceptors)
         self._server.add_insecure_port(f"{host}:{port}")
 
     @property
@@ -267,9 +272,48 @@ def main():
     parser.add_argument(
         "--vram_optimisation_level", "-V", type=int, default=os.environ.get("SD_VRAM_OPTIMISATION_LEVEL", 2), help="How much to trade off performance to reduce VRAM usage (0 = none, 2 = max)"
     )
+    parser.add_argument(
+        "--attention_backend", type=str, default=os.environ.get("SD_ATTENTION_BACKEND", None), choices=available_attention_backends(), help="How to compute attention (default = diffusers, sdpa = PyTorch 2 fused, chunked = bounded memory, xformers), from the ones available here. Defaults to the fastest available, see tests/attention_benchmark.py"
+    )
+    parser.add_argument(
+        "--fixed_optimisation", action="store_true", help="Always use the attention slicing, VAE tiling and batch sizes of the VRAM optimisation level, instead of choosing them per request from the predicted peak memory"
+    )
     parser.add_argument(
         "--nsfw_behaviour", "-N", type=str, default=os.environ.get("SD_NSFW_BEHAVIOUR", "block"), choices=["block", "flag"], help="What to do with images detected as NSFW"
     )
+    parser.add_argument(
+        "--engine_memory_budget", type=float, default=os.environ.get("SD_ENGINE_MEMORY_BUDGET", 0), help="How many GB of device memory engines can use. Engines are kept active until this is exceeded (0 = only keep one engine active)"
+    )
+    parser.add_argument(
+        "--text_embedding_cache", type=float, default=os.environ.get("SD_TEXT_EMBEDDING_CACHE", 64), help="How many MB of device memory to use caching encoded prompts, so repeated prompts skip the text encoder (0 = don't cache)"
+    )
+    parser.add_argument(
+        "--init_latent_cache", type=float, default=os.environ.get("SD_INIT_LATENT_CACHE", 32), help="How many MB of device memory to use caching encoded init images, so resampling the same image skips the VAE encoder (0 = don't cache)"
+    )
+    parser.add_argument(
+        "--batch_window", type=float, default=os.environ.get("SD_BATCH_WINDOW", 0.05), help="How many seconds to wait for compatible requests to batch together (0 = don't wait)"
+    )
+    parser.add_argument(
+        "--max_batch_size", type=int, default=os.environ.get("SD_MAX_BATCH_SIZE", 4), help="The maximum number of images to generate in a single batch"
+    )
+    parser.add_argument(
+        "--max_queue_length", type=int, default=os.environ.get("SD_MAX_QUEUE_LENGTH", 32), help="How many generation requests can wait in the queue before new ones are rejected (0 = unlimited)"
+    )
+    parser.add_argument(
+        "--queue_aging", type=float, default=os.environ.get("SD_QUEUE_AGING", 1.0), help="Shorter requests are run first, but every second a request waits counts as this many seconds less work (0 = always shortest first)"
+    )
+    parser.add_argument(
+        "--queue_usage_half_life", type=float, default=os.environ.get("SD_QUEUE_USAGE_HALF_LIFE", 60), help="How long (in seconds) it takes for the work a client has had run to count half as much against its share of the queue"
+    )
+    parser.add_argument(
+        "--max_engine_wait", type=float, default=os.environ.get("SD_MAX_ENGINE_WAIT", 30), help="Requests for the active engine are served before older requests for other engines, but only until those requests have waited this many seconds"
+    )
+    parser.add_argument(
+        "--max_engine_bypass", type=int, default=os.environ.get("SD_MAX_ENGINE_BYPASS", 8), help="The maximum number of times a request can be passed over for requests to the active engine"
+    )
+    parser.add_argument(
+        "--lazy_load", action="store_true", help="Don't load all engines before serving. Engines with a priority in engines.yaml are loaded in the background, the rest on first use"
+    )
     parser.add_argument(
         "--reload", action="store_true", help="Auto-reload on source change"
     )
@@ -290,6 +334,8 @@ def main():
     args.listen_to_all = args.listen_to_all or 'SD_LISTEN_TO_ALL' in os.environ
     args.enable_mps = args.enable_mps or 'SD_ENABLE_MPS' in os.environ
     args.reload = args.reload or 'SD_RELOAD' in os.environ
+    args.lazy_load = args.lazy_load or 'SD_LAZY_LOAD' in os.environ
+    args.fixed_optimisation = args.fixed_optimisation or 'SD_FIXED_OPTIMISATION' in os.environ
     args.localtunnel = args.localtunnel or 'SD_LOCALTUNNEL' in os.environ
 
     if args.localtunnel and not args.access_token:
@@ -327,25 +373,42 @@ def main():
         manager = EngineManager(
             engines, 
             weight_root=args.weight_root,
-            mode=EngineMode(vram_optimisation_level=args.vram_optimisation_level, enable_cuda=True, enable_mps=args.enable_mps), 
-            nsfw_behaviour=args.nsfw_behaviour
+            mode=EngineMode(vram_optimisation_level=args.vram_optimisation_level, enable_cuda=True, enable_mps=args.enable_mps, auto_optimise=not args.fixed_optimisation, attention_backend=args.attention_backend), 
+            nsfw_behaviour=args.nsfw_behaviour,
+            memory_budget=int(args.engine_memory_budget * 1024**3),
+            text_embedding_cache_size=int(args.text_embedding_cache * 1024**2),
+            init_latent_cache_size=int(args.init_latent_cache * 1024**2)
         )
 
         print("Manager loaded")
 
-        generation_pb2_grpc.add_GenerationServiceServicer_to_server(GenerationServiceServicer(manager), grpc.grpc_server)
+        batcher = GenerationBatcher(
+            manager, 
+            window=args.batch_window, 
+            max_batch_size=args.max_batch_size,
+            max_engine_wait=args.max_engine_wait,
+            max_engine_bypass=args.max_engine_bypass,
+            max_queue_length=args.max_queue_length,
+            aging=args.queue_aging,
+            usage_half_life=args.queue_usage_half_life
+        )
+
+        generation_pb2_grpc.add_GenerationServiceServicer_to_server(GenerationServiceServicer(manager, batcher), grpc.grpc_server)
         dashboard_pb2_grpc.add_DashboardServiceServicer_to_server(DashboardServiceServicer(), grpc.grpc_server)
         engines_pb2_grpc.add_EnginesServiceServicer_to_server(EnginesServiceServicer(manager), grpc.grpc_server)
 
-        generation_pb2_grpc.add_GenerationServiceServicer_to_server(GenerationServiceServicer(manager), http.grpc_server)
+        generation_pb2_grpc.add_GenerationServiceServicer_to_server(GenerationServiceServicer(manager, batcher), http.grpc_server)
         dashboard_pb2_grpc.add_DashboardServiceServicer_to_server(DashboardServiceServicer(), http.grpc_server)
         engines_pb2_grpc.add_EnginesServiceServicer_to_server(EnginesServiceServicer(manager), http.grpc_server)
 
         print(f"GRPC listening on port {args.grpc_port}, HTTP listening on port {args.http_port}. Start your engines....")
 
-        manager.loadPipelines()
-
-        print("All engines ready")
+        if args.lazy_load:
+            manager.prefetchPipelines()
+            print("Engines will load in the background or on first use")
+        else:
+            manager.loadPipelines()
+            print("All engines ready")
 
         # Block until termination
         grpc.block()
@@ -1,6 +1,6 @@
 
 from math import sqrt
-import random, traceback, threading
+import random, traceback, threading, itertools
 from types import SimpleNamespace as SN
 import torch
 
@@ -8,8 +8,11 @@ import grpc
 import generation_pb2, generation_pb2_grpc
 
 from sdgrpcserver.utils import image_to_artifact, artifact_to_image
+from sdgrpcserver.batcher import BatchJob, QueueFullError
+from sdgrpcserver.memorymodel import is_out_of_memory
 
 from sdgrpcserver import images
+from sdgrpcserver.pipeline.tiling import check_tile_size
 
 def buildDefaultMaskPostAdjustments():
     hardenMask = generation_pb2.ImageAdjustment()
@@ -34,9 +37,39 @@ defaultMaskPostAdjustments = buildDefaultMaskPostAdjustments();
 
 debugCtr=0
 
+def seedSequence(seeds, samples):
+    """
+    Yields the seed for each of `samples` samples: the client's seeds first, then counting up from the last one.
+    A seed of -1 (or no seeds at all) starts from a random seed. Lazy, so a huge (repeat until cancelled) 
+    sample count costs nothing up front
+    """
+    seeds = list(seeds)
+    last_seed = -1
+
+    for _ in range(samples):
+        seed = -1
+
+        # While we still have seeds from the client, consume them
+        if seeds:
+            seed = seeds.pop(0)
+        # Or if we have a previous seed, sequentially work from that
+        elif last_seed != -1:
+            seed = last_seed + 1
+
+        # If either the client passed -1, or they passed nothing & this is our first seed, pick something randomly
+        if seed == -1: 
+            seed = random.randrange(0, 2**32-1)
+
+        yield seed
+        last_seed = seed
+
 class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
-    def __init__(self, manager):
+    # How many images to generate in one job when there's no batcher to say
+    default_max_batch_size = 4
+
+    def __init__(self, manager, batcher=None):
         self._manager = manager
+        self._batcher = batcher
 
     def saveDebugTensor(self, tensor):
         global debugCtr
@@ -48,6 +81,29 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
     def unimp(self, what):
         raise NotImplementedError(f"{what} not implemented")
 
+    def _getClientAndPriority(self, context):
+        """
+        Work out who sent the request (their authorization token if they sent one, otherwise their address)
+        and it's priority (from the x-priority header, clamped to -4 .. 4)
+        """
+        client, priority = None, 0
+
+        for key, value in context.invocation_metadata():
+            if key == "authorization": client = value
+            elif key == "x-priority":
+                try:
+                    priority = max(-4, min(4, int(value)))
+                except ValueError:
+                    pass
+
+        if client is None:
+            try:
+                client = context.peer()
+            except NotImplementedError:
+                pass
+
+        return client, priority
+
     def _handleImageAdjustment(self, tensor, adjustments):
         if type(tensor) is bytes: tensor = images.fromPngBytes(tensor)
 
@@ -88,6 +144,38 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
         
         return tensor
 
+    def _expandSamples(self, texts, cfg_scales, params, seeds):
+        """
+        Build the text and params for one job generating a sample for each of seeds, with every guidance scale in 
+        a sweep and every text prompt - all in the same batch, so the text embeddings and init latents are shared
+        and the UNet runs on all of them together. Returns the text, params, and each image's seed, guidance scale 
+        (None if not sweeping) and prompt index (None for a single prompt), in the order the images come back
+        """
+        params = SN(**vars(params))
+
+        # For a guidance scale sweep, each sample is repeated once per scale
+        request_seeds = list(seeds)
+        request_scales = [None] * len(request_seeds)
+        if cfg_scales:
+            request_seeds = [seed for seed in seeds for _ in cfg_scales]
+            request_scales = cfg_scales * len(seeds)
+            params.cfg_scale = request_scales
+
+        # Each text prompt is a separate set of samples (with the same seeds)
+        text = texts[0] if texts else ""
+        request_prompts = [None] * len(request_seeds)
+        if len(texts) > 1:
+            request_prompts = [prompt_index for prompt_index in range(len(texts)) for _ in request_seeds]
+            text = [texts[prompt_index] for prompt_index in request_prompts]
+            request_seeds = request_seeds * len(texts)
+            request_scales = request_scales * len(texts)
+            if cfg_scales: params.cfg_scale = request_scales
+
+        params.seed = request_seeds
+        params.samples = len(seeds)
+
+        return text, params, request_seeds, request_scales, request_prompts
+
     def Generate(self, request, context):
         try:
             # Assume that "None" actually means "Image" (stability-sdk/client.py doesn't set it)
@@ -98,7 +186,7 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
             image=None
             inMask=None
             outMask=None
-            text=""
+            texts=[]
             negative=""
 
             for prompt in request.prompt:
@@ -108,7 +196,7 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
                     if prompt.HasField("parameters") and prompt.parameters.HasField("weight") and prompt.parameters.weight < 0:
                         negative += prompt.text
                     else:
-                        text += prompt.text
+                        texts.append(prompt.text)
                 elif which == "sequence": 
                     self.unimp("Sequence prompts")
                 else:
@@ -135,7 +223,11 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
                 steps=50,
                 seed=-1,
                 samples=1,
-                strength=0.8
+                strength=0.8,
+                sigma_schedule=None,
+                guidance_cutoff=None,
+                guidance_cutoff_delta=None,
+                tile_size=None
             )
 
             for field in vars(params):
@@ -146,48 +238,81 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
                     pass
             
             seeds = list(request.image.seed)
+            cfg_scales = None
 
             for extras in request.image.parameters:
                 if extras.HasField("sampler"):
                     if extras.sampler.HasField("cfg_scale"): params.cfg_scale = extras.sampler.cfg_scale
+                    if extras.sampler.cfg_scales: cfg_scales = list(extras.sampler.cfg_scales)
                     if extras.sampler.HasField("eta"): params.eta = extras.sampler.eta
+                    if extras.sampler.HasField("sigma_schedule"): params.sigma_schedule = extras.sampler.sigma_schedule
+                    if extras.sampler.HasField("guidance_cutoff"): params.guidance_cutoff = extras.sampler.guidance_cutoff
+                    if extras.sampler.HasField("guidance_cutoff_delta"): params.guidance_cutoff_delta = extras.sampler.guidance_cutoff_delta
+                    if extras.sampler.HasField("tile_size"): params.tile_size = extras.sampler.tile_size
                 if extras.HasField("schedule"):
                     if extras.schedule.HasField("start"): params.strength = extras.schedule.start            
             
             if request.image.HasField("transform") and request.image.transform.WhichOneof("type") == "diffusion": params.sampler = request.image.transform.diffusion
 
-            try:
-                pipe = self._manager.getPipe(request.engine_id)
-            except KeyError as e:
+            # A tiny tile size would mean thousands of UNet tiles per step, so reject anything unusable before it's queued
+            if params.tile_size is not None:
+                try:
+                    check_tile_size(params.tile_size)
+                except ValueError as e:
+                    context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                    context.set_details(str(e))
+                    return
+
+            if request.engine_id not in self._manager.getStatus():
                 context.set_code(grpc.StatusCode.NOT_FOUND)
                 context.set_details("Engine not found")
                 return
 
+            # If the engine is still loading (or hasn't been loaded yet) wait for it
+            self._manager.loadPipeline(request.engine_id)
+
             stop_event = threading.Event()
             context.add_callback(lambda: stop_event.set())
 
-            ctr = 0
-            last_seed = -1
-
-            for _ in range(params.samples):
-                seed = -1
-
-                # While we still have seeds from the client, consume them
-                if seeds:
-                    seed = seeds.pop(0)
-                # Or if we have a previous seed, sequentially work from that
-                elif last_seed != -1:
-                    seed = last_seed + 1
+            # Each sample is repeated once per guidance scale in a sweep, and once per text prompt
+            rows_per_sample = max(len(cfg_scales or [None]) * len(texts or [None]), 1)
+            max_batch_size = self._batcher.max_batch_size if self._batcher else self.default_max_batch_size
 
-                # If either the client passed -1, or they passed nothing & this is our first seed, pick something randomly
-                if seed == -1: 
-                    seed = random.randrange(0, 2**32-1)
+            # Samples are generated a bounded chunk at a time (each chunk a single batch, each sample with it's own seed),
+            # and each chunk's images are sent as soon as it's done
+            samples_per_job = max(1, max_batch_size // rows_per_sample)
+            seed_sequence = seedSequence(seeds, params.samples)
 
-                params.seed = last_seed = seed
-                print(f'Generating {repr(params)}, {"with Image" if image != None else ""}, {"with Mask" if inMask != None else ""}')
-                results = pipe.generate(text=text, negative_text=negative, image=image, mask=inMask, outmask=outMask, params=params, stop_event=stop_event)
+            ctr = 0
+            queue_positions, queue_wait = [], 0
+
+            while not stop_event.is_set():
+                chunk_seeds = list(itertools.islice(seed_sequence, samples_per_job))
+                if not chunk_seeds: break
+
+                job_text, job_params, request_seeds, request_scales, request_prompts = self._expandSamples(texts, cfg_scales, params, chunk_seeds)
+
+                print(f'Generating {repr(job_params)}, {"with Image" if image != None else ""}, {"with Mask" if inMask != None else ""}')
+                client, priority = self._getClientAndPriority(context) if self._batcher else (None, 0)
+                job = BatchJob(
+                    request.engine_id, job_text, job_params, 
+                    image=image, mask=inMask, outmask=outMask, negative_text=negative, 
+                    stop_event=stop_event,
+                    client=client, priority=priority
+                )
+
+                if self._batcher:
+                    position = self._batcher.enqueue(job)
+                    if not queue_positions: context.send_initial_metadata((("x-queue-position", str(position)),))
+                    results = job.wait()
+                    print(f"Request {request.request_id} was queued at position {position} and waited {job.wait_time:.2f}s")
+                    queue_positions.append(position)
+                    queue_wait += job.wait_time
+                else:
+                    pipe = self._manager.getPipe(request.engine_id)
+                    results = pipe.generate(text=job.text, negative_text=job.negative_text, image=job.image, mask=job.mask, outmask=job.outmask, params=job.params, stop_event=job.stop_event)
 
-                for result_image, nsfw in zip(results[0], results[1]):
+                for result_image, nsfw, seed, cfg_scale, prompt_index in zip(results[0], results[1], request_seeds, request_scales, request_prompts):
                     answer = generation_pb2.Answer()
                     answer.request_id=request.request_id
                     answer.answer_id=f"{request.request_id}-{ctr}"
@@ -195,16 +320,35 @@ class GenerationServiceServicer(generation_pb2_grpc.GenerationServiceServicer):
                     artifact.finish_reason=generation_pb2.FILTER if nsfw else generation_pb2.NULL
                     artifact.index=ctr
                     artifact.seed=seed
+                    if cfg_scale is not None: artifact.cfg_scale=cfg_scale
+                    if prompt_index is not None: artifact.prompt_index=prompt_index
                     answer.artifacts.append(artifact)
- 
+
                     yield answer
                     ctr += 1
+
+            if queue_positions:
+                context.set_trailing_metadata((
+                    ("x-queue-position", str(queue_positions[0])), 
+                    ("x-queue-wait-ms", str(int(queue_wait * 1000)))
+                ))
             
+        except QueueFullError as e:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            context.set_details(str(e))
+            print(f"Rejected request: {e}")
         except NotImplementedError as e:
             context.set_code(grpc.StatusCode.UNIMPLEMENTED)
             context.set_details(str(e))
             print(f"Unsupported request parameters: {e}")
         except Exception as e:
+            # Batches that run out of memory are split and retried, so this is a single image too big to generate
+            if is_out_of_memory(e):
+                context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+                context.set_details("Not enough memory to generate an image this size")
+                print(f"Out of memory: {e}")
+                return
+
             traceback.print_exc()
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details("Something went wrong")
@@ -0,0 +1,100 @@
+import os, sys, time, argparse
+
+import torch
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+
+from sdgrpcserver.pipeline.fastattention import BackendCrossAttention, available_attention_backends, set_attention_backend
+
+# Times each available attention backend on the attention layers of a Stable Diffusion 1.x UNet, to pick the
+# best --attention_backend for a host. Runs on the CPU by default (--device cuda also reports peak memory).
+#
+# Each case is one BackendCrossAttention with random weights, run on the inputs it sees in a guided batch:
+# self attention at each feature map size, and cross attention to the 77 prompt tokens, with and without a
+# mask. Every backend's output is checked against the default backend's.
+
+def cases(args):
+    latent = args.size // 8
+    batch = args.batch * 2
+
+    for scale, channels in ((1, 320), (2, 640), (4, 1280)):
+        tokens = (latent // scale) ** 2
+        yield f"self {latent // scale}x{latent // scale}", channels, tokens, None, None
+        yield f"cross {latent // scale}x{latent // scale}", channels, tokens, 768, None
+
+    # The last quarter of the prompt tokens masked out
+    mask = torch.ones((batch, 77), dtype=torch.bool)
+    mask[:, -77 // 4:] = False
+    yield f"masked {latent}x{latent}", 320, latent * latent, 768, mask
+
+def run(layer, hidden_states, context, mask, args):
+    for _ in range(args.warmup): layer(hidden_states, context=context, mask=mask)
+
+    if hidden_states.device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    for _ in range(args.repeats): out = layer(hidden_states, context=context, mask=mask)
+    if hidden_states.device.type == "cuda": torch.cuda.synchronize()
+
+    seconds = (time.perf_counter() - start) / args.repeats
+    peak = torch.cuda.max_memory_allocated() if hidden_states.device.type == "cuda" else None
+    return out, seconds, peak
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--size", type=int, default=512, help="Image width and height")
+    parser.add_argument("--batch", type=int, default=1, help="Images per batch (each is run twice, for guidance)")
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--fp16", action="store_true")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = torch.float16 if args.fp16 else torch.float32
+    backends = available_attention_backends()
+
+    print(f"Attention on {args.device}, {args.size}x{args.size}, batch {args.batch}, {args.heads} heads, {dtype}")
+    print(f"{'case':>16} " + " ".join(f"{backend:>26}" for backend in backends))
+
+    torch.manual_seed(0)
+    totals = {backend: 0 for backend in backends}
+
+    with torch.no_grad():
+        for name, channels, tokens, context_dim, mask in cases(args):
+            layer = BackendCrossAttention(channels, context_dim, heads=args.heads, dim_head=channels // args.heads).to(device, dtype)
+
+            hidden_states = torch.randn((args.batch * 2, tokens, channels), device=device, dtype=dtype)
+            context = torch.randn((args.batch * 2, 77, context_dim), device=device, dtype=dtype) if context_dim else None
+            if mask is not None: mask = mask.to(device)
+
+            reference, cells = None, []
+            for backend in backends:
+                set_attention_backend(layer, backend)
+
+                try:
+                    out, seconds, peak = run(layer, hidden_states, context, mask, args)
+                except Exception as e:
+                    cells.append(f"{'failed':>26}")
+                    totals[backend] = float("inf")
+                    print(f"{backend} failed on {name}: {e}")
+                    continue
+
+                if reference is None: reference = out
+                error = (out - reference).abs().max().item()
+
+                totals[backend] += seconds
+                cell = f"{seconds * 1000:8.2f}ms"
+                if peak is not None: cell += f" {peak / 1024**2:5.0f}MB"
+                # Followed by the largest difference from the first backend's output
+                cells.append(f"{cell} {error:7.0e}".rjust(26) if out is not reference else f"{cell} {'-':>7}".rjust(26))
+
+            print(f"{name:>16} " + " ".join(cells))
+
+    print(f"{'total':>16} " + " ".join(f"{totals[backend] * 1000:24.2f}ms" for backend in backends))
+    print(f"Fastest: {min(backends, key=lambda backend: totals[backend])}")
@@ -0,0 +1,125 @@
+import os, sys, time, argparse
+from types import SimpleNamespace as SN
+
+import torch
+
+import yaml
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+
+from sdgrpcserver.manager import EngineMode, EngineManager
+
+import generation_pb2
+
+# Quality / speed report for truncated classifier free guidance.
+#
+# Generates the same prompts and seeds with full guidance, and then with each of the guidance_cutoff and
+# guidance_cutoff_delta settings, and reports how long each took and how far the images drifted from the
+# fully guided ones (mean absolute pixel difference and PSNR, higher is closer). Images are written to out/
+# so they can be compared by eye as well.
+#
+# Needs the weights in testengines.yaml, like happy_path.py
+
+PROMPTS = [
+    "A digital painting of a shark in the deep ocean, highly detailed, trending on artstation",
+    "A photo of a red fox in the snow, 85mm, bokeh",
+    "An isometric render of a tiny medieval village, soft lighting",
+]
+
+SEEDS = [420420420, 1, 12345]
+
+SETTINGS = [
+    ("full", {}),
+    ("cutoff_0.8", dict(guidance_cutoff=0.8)),
+    ("cutoff_0.7", dict(guidance_cutoff=0.7)),
+    ("cutoff_0.6", dict(guidance_cutoff=0.6)),
+    ("cutoff_0.5", dict(guidance_cutoff=0.5)),
+    ("delta_0.02", dict(guidance_cutoff_delta=0.02)),
+    ("delta_0.04", dict(guidance_cutoff_delta=0.04)),
+]
+
+samplers = {
+    "ddim": generation_pb2.SAMPLER_DDIM,
+    "k_euler": generation_pb2.SAMPLER_K_EULER,
+    "k_euler_ancestral": generation_pb2.SAMPLER_K_EULER_ANCESTRAL,
+    "k_lms": generation_pb2.SAMPLER_K_LMS,
+    "k_dpmpp_2m": generation_pb2.SAMPLER_K_DPMPP_2M,
+}
+
+def generate(pipe, prompt, args, extra):
+    params = SN(
+        height=512, width=512, cfg_scale=args.cfg_scale, eta=0, sampler=samplers[args.sampler], steps=args.steps,
+        seed=SEEDS, samples=1, strength=0.8, sigma_schedule=None, guidance_cutoff=None, guidance_cutoff_delta=None
+    )
+    for key, value in extra.items(): setattr(params, key, value)
+
+    if torch.cuda.is_available(): torch.cuda.synchronize()
+    start = time.monotonic()
+
+    images, _ = pipe.generate(text=prompt, params=params)
+
+    if torch.cuda.is_available(): torch.cuda.synchronize()
+    return images.float(), time.monotonic() - start
+
+def psnr(images, reference):
+    mse = ((images - reference) ** 2).flatten(1).mean(dim=1)
+    return (10 * torch.log10(1 / mse.clamp(min=1e-10))).mean().item()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", type=str, default="stable-diffusion-v1-4")
+    parser.add_argument("--sampler", type=str, default="k_euler", choices=samplers.keys())
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--cfg_scale", type=float, default=7.5)
+    args = parser.parse_args()
+
+    with open(os.path.normpath("testengines.yaml"), 'r') as cfg:
+        engines = yaml.load(cfg, Loader=Loader)
+
+    manager = EngineManager(
+        engines,
+        weight_root="../weights/",
+        mode=EngineMode(vram_optimisation_level=0, enable_cuda=True, enable_mps=False),
+        nsfw_behaviour="flag"
+    )
+
+    manager.loadPipelines()
+    pipe = manager.getPipe(args.engine)
+
+    # Warm up, so the first setting isn't charged for it
+    generate(pipe, PROMPTS[0], args, {})
+
+    os.makedirs("out", exist_ok=True)
+
+    results = {name: dict(seconds=0, diff=0, psnr=0) for name, _ in SETTINGS}
+
+    for prompt_idx, prompt in enumerate(PROMPTS):
+        reference = None
+
+        for name, extra in SETTINGS:
+            images, seconds = generate(pipe, prompt, args, extra)
+            if reference is None: reference = images
+
+            results[name]["seconds"] += seconds
+            if images is not reference:
+                results[name]["diff"] += (images - reference).abs().mean().item() / len(PROMPTS)
+                results[name]["psnr"] += psnr(images, reference) / len(PROMPTS)
+
+            for i, image in enumerate(images):
+                pil = pipe._pipeline.numpy_to_pil(image.permute(1, 2, 0).numpy())[0]
+                pil.save(f"out/guidance_{args.sampler}_{prompt_idx}_{SEEDS[i]}_{name}.png")
+
+    full = results["full"]["seconds"]
+
+    print(f"Truncated guidance, {args.sampler}, {args.steps} steps, cfg scale {args.cfg_scale}, {len(PROMPTS)} prompts x {len(SEEDS)} seeds")
+    print(f"{'setting':>12} {'seconds':>9} {'speedup':>8} {'mean diff':>10} {'psnr':>7}")
+    for name, _ in SETTINGS:
+        result = results[name]
+        quality = f"{result['diff']:10.4f} {result['psnr']:7.2f}" if name != "full" else f"{'-':>10} {'-':>7}"
+        print(f"{name:>12} {result['seconds']:9.2f} {full / result['seconds']:7.2f}x {quality}")
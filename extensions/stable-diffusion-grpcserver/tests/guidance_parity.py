@@ -0,0 +1,73 @@
+import os, sys
+from types import SimpleNamespace as SN
+
+import torch
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+
+from sdgrpcserver.pipeline.unified_pipeline import NoisePredictor
+from sdgrpcserver.pipeline.schedulers.scheduling_ddim import DDIMScheduler
+
+# Checks that a guidance scale sweep mixing scales of 1 or less (which aren't guided on their own) with larger
+# ones gives every row the same noise prediction it gets when generated alone (with a plain float scale), in
+# float32 and in float16 - including scales like 7.3 that float16 can't represent exactly.
+#
+# Doesn't need any weights - the UNet is replaced with a fake, row-independant noise prediction that depends
+# on the text embeddings, so the conditional and unconditional predictions differ
+
+SCALES = [1.0, 7.5, 0.5, 12.0, 7.3]
+SHAPE = (4, 64, 64)
+STEPS = 10
+
+class FakeUNet:
+    def __call__(self, latents, t, encoder_hidden_states):
+        embedding = encoder_hidden_states.mean(dim=(1, 2))[:, None, None, None]
+        return SN(sample=torch.tanh(latents * 0.5 + embedding))
+
+def predict(scheduler, latents, cond, uncond, guidance_scale):
+    # The same way UnifiedPipeline.__call__ builds the NoisePredictor, for a list of guidance scales or a single one
+    if isinstance(guidance_scale, list):
+        guidance_scale = [max(scale, 1.0) for scale in guidance_scale]
+        do_classifier_free_guidance = max(guidance_scale) > 1.0
+
+        if len(set(guidance_scale)) == 1: guidance_scale = guidance_scale[0]
+        else: guidance_scale = torch.tensor(guidance_scale, dtype=torch.float32)[:, None, None, None]
+    else:
+        do_classifier_free_guidance = guidance_scale > 1.0
+
+    text_embeddings = torch.cat([uncond, cond]) if do_classifier_free_guidance else cond
+
+    noise_predictor = NoisePredictor(
+        pipeline=SN(unet=FakeUNet()),
+        scheduler=scheduler,
+        text_embeddings=text_embeddings,
+        do_classifier_free_guidance=do_classifier_free_guidance,
+        guidance_scale=guidance_scale,
+        num_inference_steps=STEPS
+    )
+
+    t = scheduler.timesteps[0]
+    return noise_predictor.step(latents, 0, t)
+
+if __name__ == "__main__":
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False, set_alpha_to_one=False)
+    scheduler.set_timesteps(STEPS)
+
+    results = []
+    for dtype in (torch.float32, torch.float16):
+        generator = torch.Generator().manual_seed(0)
+        latents = torch.randn((len(SCALES), *SHAPE), generator=generator).to(dtype)
+        cond = torch.randn((len(SCALES), 77, 768), generator=generator).to(dtype)
+        uncond = torch.randn((1, 77, 768), generator=generator).expand(len(SCALES), -1, -1).to(dtype)
+
+        batched = predict(scheduler, latents, cond, uncond, SCALES)
+
+        for i, scale in enumerate(SCALES):
+            alone = predict(scheduler, latents[i:i+1], cond[i:i+1], uncond[i:i+1], scale)
+            ok = torch.equal(batched[i:i+1], alone)
+            print(f"scale {scale}, {dtype}: {'PASS' if ok else 'FAIL'}")
+            results.append(ok)
+
+    sys.exit(0 if all(results) else -1)
@@ -30,6 +30,8 @@ algorithms = {
     "k_dpm_2": generation_pb2.SAMPLER_K_DPM_2,
     "k_dpm_2_ancestral": generation_pb2.SAMPLER_K_DPM_2_ANCESTRAL,
     "k_lms": generation_pb2.SAMPLER_K_LMS,
+    "k_dpmpp_2m": generation_pb2.SAMPLER_K_DPMPP_2M,
+    "unipc": generation_pb2.SAMPLER_UNIPC,
 }
 
 args = {
@@ -43,6 +45,8 @@ args = {
         {"sampler": "k_heun"}, 
         {"sampler": "k_dpm_2"}, 
         {"sampler": "k_dpm_2_ancestral"}, 
+        {"sampler": "k_dpmpp_2m"}, 
+        {"sampler": "unipc"}, 
     ],
     "image": [
         {},
@@ -0,0 +1,171 @@
+import os, sys, inspect
+from types import SimpleNamespace as SN
+
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+
+from sdgrpcserver.pipeline.randtools import LatentNoiseFactory
+from sdgrpcserver.pipeline.unified_pipeline import Txt2imgMode, Img2imgMode, EnhancedInpaintMode
+from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin
+from sdgrpcserver.pipeline.schedulers.scheduling_ddim import DDIMScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_euler_discrete import EulerDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_euler_ancestral_discrete import EulerAncestralDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_discrete import DPM2DiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_ancestral_discrete import DPM2AncestralDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_heun_discrete import HeunDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_dpmpp_2m_discrete import DPMPP2MDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_unipc_discrete import UniPCDiscreteScheduler
+
+# Checks that the noise a seed gets (both the initial latents and any noise added by the sampler during
+# a step) doesn't depend on the batch size or the position of the seed in the batch.
+#
+# First for each scheduler on it's own, then for each of UnifiedPipeline's modes (the txt2img initial latents, 
+# the img2img init latent sampling, and the inpaint shaped noise fill) run through the same denoising loop as 
+# UnifiedPipeline.__call__.
+#
+# Doesn't need any weights - the UNet is replaced with a fake, row-independant noise prediction, and the VAE
+# encoder with a fake that downsamples the image
+
+SEEDS = [420420420, 1, 12345, 2**32-2]
+SHAPE = (4, 64, 64)
+STEPS = 10
+
+def schedulers():
+    common = dict(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+
+    yield "ddim", DDIMScheduler(clip_sample=False, set_alpha_to_one=False, **common), dict(eta=0.8)
+    yield "k_euler", EulerDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), dict(s_churn=1.0)
+    yield "k_euler_ancestral", EulerAncestralDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+    yield "k_heun", HeunDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), dict(s_churn=1.0)
+    yield "k_dpm_2", DPM2DiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), dict(s_churn=1.0)
+    yield "k_dpm_2_ancestral", DPM2AncestralDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+    yield "k_dpmpp_2m", DPMPP2MDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+    yield "unipc", UniPCDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+
+def fake_unet(latents, *_):
+    return torch.tanh(latents * 0.5)
+
+def run(scheduler, extra, seeds):
+    noise = LatentNoiseFactory.fromSeeds(seeds, "cpu")
+
+    scheduler.set_timesteps(STEPS)
+
+    latents = noise.randn((len(seeds), *SHAPE), "cpu")
+    if isinstance(scheduler, OldSchedulerMixin): latents = latents * scheduler.sigmas[0]
+    else: latents = latents * scheduler.init_noise_sigma
+
+    step_args = set(inspect.signature(scheduler.step).parameters.keys())
+
+    kwargs = {key: value for key, value in extra.items() if key in step_args}
+    if "generator" in step_args: kwargs["generator"] = noise
+    if "noise_predictor" in step_args: kwargs["noise_predictor"] = fake_unet
+
+    for i, t in enumerate(scheduler.timesteps):
+        step_t = i if isinstance(scheduler, OldSchedulerMixin) else t
+        latents = scheduler.step(fake_unet(latents), step_t, latents, **kwargs).prev_sample
+
+    return latents
+
+def check(name, scheduler, extra):
+    batched = run(scheduler, extra, SEEDS)
+    reversed_batch = run(scheduler, extra, SEEDS[::-1]).flip(0)
+
+    ok = torch.equal(batched, reversed_batch)
+
+    for i, seed in enumerate(SEEDS):
+        alone = run(scheduler, extra, [seed])
+        ok = ok and torch.equal(batched[i:i+1], alone)
+
+    print(f"{name}: {'PASS' if ok else 'FAIL'}")
+    return ok
+
+IMAGE_SIZE = SHAPE[1] * 8
+
+def fake_vae_encode(images, max_pixels="default"):
+    # Mean from the downsampled image (plus a fourth channel), and a fixed log variance
+    pooled = torch.nn.functional.avg_pool2d(images, 8)
+    mean = torch.cat([pooled, pooled.mean(dim=1, keepdim=True)], dim=1)
+    return DiagonalGaussianDistribution(torch.cat([mean, torch.full_like(mean, -2.0)], dim=1))
+
+def fake_pipeline():
+    return SN(
+        device=torch.device("cpu"),
+        unet=SN(in_channels=SHAPE[0]),
+        init_latent_cache=None,
+        _vae=None,
+        _encode_images=fake_vae_encode
+    )
+
+def mode_inputs():
+    generator = torch.Generator().manual_seed(0)
+    init_image = torch.rand((3, IMAGE_SIZE, IMAGE_SIZE), generator=generator)
+
+    # Repaint the middle of the image, keep the rest
+    mask_image = torch.ones((3, IMAGE_SIZE, IMAGE_SIZE))
+    mask_image[:, IMAGE_SIZE//4:-IMAGE_SIZE//4, IMAGE_SIZE//4:-IMAGE_SIZE//4] = 0
+
+    yield "txt2img", Txt2imgMode, {}
+    yield "img2img", Img2imgMode, dict(init_image=init_image, strength=0.6)
+    yield "inpaint", EnhancedInpaintMode, dict(init_image=init_image, mask_image=mask_image, strength=1.0)
+
+def run_mode(mode_class, inputs, scheduler, extra, seeds):
+    # The same steps as UnifiedPipeline.__call__, without the guidance or the decode
+    noise = LatentNoiseFactory.fromSeeds(seeds, "cpu")
+
+    scheduler.set_timesteps(STEPS)
+
+    mode = mode_class(
+        pipeline=fake_pipeline(),
+        scheduler=scheduler,
+        generator=noise,
+        width=IMAGE_SIZE, height=IMAGE_SIZE,
+        latents_dtype=torch.float32,
+        batch_total=len(seeds),
+        num_inference_steps=STEPS,
+        **{"strength": 1.0, **inputs}
+    )
+
+    latents = mode.generateLatents()
+
+    step_args = set(inspect.signature(scheduler.step).parameters.keys())
+
+    kwargs = {key: value for key, value in extra.items() if key in step_args}
+    if "generator" in step_args: kwargs["generator"] = noise
+    if "noise_predictor" in step_args: kwargs["noise_predictor"] = fake_unet
+
+    timesteps = scheduler.timesteps[mode.t_start:]
+
+    for i, t in enumerate(timesteps):
+        t_index = mode.t_start + i
+        step_t = t_index if isinstance(scheduler, OldSchedulerMixin) else t
+        latents = scheduler.step(fake_unet(latents), step_t, latents, **kwargs).prev_sample
+        latents = mode.latentStep(latents, t_index, t, i / (timesteps.shape[0] + 1))
+
+    return latents
+
+def check_mode(name, mode_class, inputs, scheduler, extra):
+    run = lambda seeds: run_mode(mode_class, inputs, scheduler, extra, seeds)
+
+    batched = run(SEEDS)
+    ok = torch.equal(batched, run(SEEDS[::-1]).flip(0))
+
+    for i, seed in enumerate(SEEDS):
+        ok = ok and torch.equal(batched[i:i+1], run([seed]))
+
+    print(f"{name}: {'PASS' if ok else 'FAIL'}")
+    return ok
+
+if __name__ == "__main__":
+    results = [check(name, scheduler, extra) for name, scheduler, extra in schedulers()]
+
+    # One scheduler that adds noise during each step and one that doesn't is enough to cover the modes
+    for scheduler_name, scheduler, extra in schedulers():
+        if scheduler_name not in {"ddim", "k_euler_ancestral"}: continue
+        for mode_name, mode_class, inputs in mode_inputs():
+            results.append(check_mode(f"{mode_name} with {scheduler_name}", mode_class, inputs, scheduler, extra))
+
+    sys.exit(0 if all(results) else -1)
@@ -0,0 +1,95 @@
+import os, sys, time, inspect, argparse
+
+import torch
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+
+from sdgrpcserver.pipeline.randtools import LatentNoiseFactory
+from sdgrpcserver.pipeline.old_schedulers.scheduling_utils import OldSchedulerMixin
+from sdgrpcserver.pipeline.schedulers.scheduling_ddim import DDIMScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_euler_discrete import EulerDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_euler_ancestral_discrete import EulerAncestralDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_discrete import DPM2DiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_dpm2_ancestral_discrete import DPM2AncestralDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_heun_discrete import HeunDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_dpmpp_2m_discrete import DPMPP2MDiscreteScheduler
+from sdgrpcserver.pipeline.old_schedulers.scheduling_unipc_discrete import UniPCDiscreteScheduler
+
+# Measures the per-step overhead of each sampler - everything a step costs apart from the UNet itself.
+#
+# The UNet is replaced with a fake, and the latents are tiny, so the time is dominated by the scheduler's
+# own work: python, scalar schedule math, kernel launches and (on CUDA) any host-device syncs. Runs on the
+# CPU by default. With --device cuda, torch's sync debug mode is turned on, so any step that syncs with
+# the host will print a warning.
+
+def schedulers():
+    common = dict(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+
+    yield "ddim", DDIMScheduler(clip_sample=False, set_alpha_to_one=False, **common), dict(eta=0.8)
+    yield "k_euler", EulerDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), dict(s_churn=1.0)
+    yield "k_euler_ancestral", EulerAncestralDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+    yield "k_heun", HeunDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), dict(s_churn=1.0)
+    yield "k_dpm_2", DPM2DiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), dict(s_churn=1.0)
+    yield "k_dpm_2_ancestral", DPM2AncestralDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+    yield "k_dpmpp_2m", DPMPP2MDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+    yield "unipc", UniPCDiscreteScheduler(num_train_timesteps=1000, **common).set_format("pt"), {}
+
+def fake_unet(latents, *_):
+    return latents * 0.5
+
+def run(scheduler, extra, args, device):
+    noise = LatentNoiseFactory.fromSeeds(range(1, args.batch + 1), device)
+
+    scheduler.set_timesteps(args.steps, device=device)
+
+    latents = noise.randn((args.batch, 4, args.size, args.size), device)
+    if isinstance(scheduler, OldSchedulerMixin): latents = latents * scheduler.sigmas[0]
+    else: latents = latents * scheduler.init_noise_sigma
+
+    step_args = set(inspect.signature(scheduler.step).parameters.keys())
+
+    kwargs = {key: value for key, value in extra.items() if key in step_args}
+    if "generator" in step_args: kwargs["generator"] = noise
+    if "noise_predictor" in step_args: kwargs["noise_predictor"] = fake_unet
+
+    for i, t in enumerate(scheduler.timesteps):
+        step_t = i if isinstance(scheduler, OldSchedulerMixin) else t
+        latents = scheduler.step(fake_unet(latents), step_t, latents, **kwargs).prev_sample
+
+    return latents
+
+def bench(name, scheduler, extra, args):
+    device = torch.device(args.device)
+
+    # Warm up (this also builds and caches the schedule tables)
+    run(scheduler, extra, args, device)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.set_sync_debug_mode("warn")
+
+    start = time.perf_counter()
+    for _ in range(args.repeats): run(scheduler, extra, args, device)
+
+    if device.type == "cuda":
+        torch.cuda.set_sync_debug_mode("default")
+        torch.cuda.synchronize()
+
+    per_step = (time.perf_counter() - start) / (args.repeats * args.steps)
+    print(f"{name:>20}: {per_step * 1e6:8.1f} us/step")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--size", type=int, default=8, help="Latent width and height")
+    args = parser.parse_args()
+
+    print(f"Per-step overhead on {args.device}, {args.steps} steps, batch {args.batch}, latents {args.size}x{args.size}")
+
+    with torch.no_grad():
+        for name, scheduler, extra in schedulers(): bench(name, scheduler, extra, args)
@@ -0,0 +1,58 @@
+import os, sys
+
+import grpc
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+sys.path.append(os.path.join(basePath, "sdgrpcserver", "generated"))
+
+from sdgrpcserver.services.generate import GenerationServiceServicer
+
+import generation_pb2
+
+# Checks that Generate rejects an unusable tile_size with INVALID_ARGUMENT before the request gets anywhere
+# near an engine, and lets usable ones through.
+#
+# Doesn't need any weights - the engine manager is a fake that only records whether it was asked for an engine
+
+class FakeManager:
+    def __init__(self):
+        self.asked = False
+
+    def getStatus(self):
+        self.asked = True
+        # No engines, so a valid request stops at NOT_FOUND
+        return {}
+
+class FakeContext:
+    def __init__(self):
+        self.code = None
+        self.details = None
+
+    def set_code(self, code): self.code = code
+    def set_details(self, details): self.details = details
+
+def request(tile_size):
+    sampler = generation_pb2.SamplerParameters(tile_size=tile_size)
+    return generation_pb2.Request(
+        engine_id="stable-diffusion-v1-4",
+        request_id="tile-size",
+        prompt=[generation_pb2.Prompt(text="A digital painting of a shark in the deep ocean")],
+        image=generation_pb2.ImageParameters(width=1024, height=1024, parameters=[generation_pb2.StepParameter(sampler=sampler)])
+    )
+
+def check(tile_size, valid):
+    manager, context = FakeManager(), FakeContext()
+    list(GenerationServiceServicer(manager).Generate(request(tile_size), context))
+
+    if valid: ok = context.code == grpc.StatusCode.NOT_FOUND and manager.asked
+    else: ok = context.code == grpc.StatusCode.INVALID_ARGUMENT and not manager.asked
+
+    print(f"tile_size {tile_size}: {'PASS' if ok else 'FAIL'} ({context.code}, {context.details})")
+    return ok
+
+if __name__ == "__main__":
+    cases = [(0, False), (64, False), (128, False), (200, False), (500, False), (192, True), (512, True), (768, True)]
+    results = [check(tile_size, valid) for tile_size, valid in cases]
+    sys.exit(0 if all(results) else -1)
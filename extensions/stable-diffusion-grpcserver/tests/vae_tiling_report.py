@@ -0,0 +1,81 @@
+import os, sys, argparse
+
+import torch
+import numpy as np
+from PIL import Image
+
+basePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.append(basePath)
+
+from diffusers.models import AutoencoderKL
+
+from sdgrpcserver.pipeline.tiling import tiled_vae_decode, tiled_vae_encode
+
+# Quality report for tiled VAE encoding and decoding.
+#
+# Encodes image.png at each size with the real AutoencoderKL, then decodes the latents whole and tiled (and
+# encodes whole and tiled), and reports how far the tiled results are from the whole ones: mean and largest
+# absolute pixel difference, PSNR (higher is closer), and the largest shift in any channel's mean (a colour
+# shift). Sizes at or under 64x64 latents fit in one tile, so they come out identical. The decodes are
+# written to out/ so any seams can be checked by eye as well.
+#
+# Needs the weights in testengines.yaml, like happy_path.py
+
+SIZES = [(512, 512), (640, 512), (768, 768), (1024, 1024), (1536, 1024)]
+
+def load_image(width, height, device, dtype):
+    image = Image.open("image.png").convert("RGB").resize((width, height), resample=Image.LANCZOS)
+    image = torch.from_numpy(np.array(image).astype(np.float32) / 255.0).permute(2, 0, 1)[None]
+    return (2.0 * image - 1.0).to(device, dtype)
+
+def to_unit(images):
+    return (images.float() / 2 + 0.5).clamp(0, 1)
+
+def compare(images, reference):
+    diff = (images - reference).abs()
+    mse = ((images - reference) ** 2).mean().clamp(min=1e-10)
+    colour = (images.mean(dim=(2, 3)) - reference.mean(dim=(2, 3))).abs().max()
+    return diff.mean().item(), diff.max().item(), (10 * torch.log10(1 / mse)).item(), colour.item()
+
+def save(images, path):
+    array = (images[0].permute(1, 2, 0).cpu().numpy() * 255).round().astype("uint8")
+    Image.fromarray(array).save(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", type=str, default="../weights/stable-diffusion-v1-4")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--fp16", action="store_true")
+    args = parser.parse_args()
+
+    dtype = torch.float16 if args.fp16 else torch.float32
+    vae = AutoencoderKL.from_pretrained(args.weights, subfolder="vae", torch_dtype=dtype).to(args.device)
+
+    os.makedirs("out", exist_ok=True)
+
+    print(f"Tiled VAE against whole, on {args.device}, {dtype}")
+    print(f"{'size':>10} {'stage':>7} {'mean diff':>10} {'max diff':>9} {'psnr':>7} {'colour':>7}")
+
+    with torch.no_grad():
+        for width, height in SIZES:
+            image = load_image(width, height, args.device, dtype)
+
+            whole_dist = vae.encode(image).latent_dist
+            tiled_dist = tiled_vae_encode(vae, image)
+
+            # Decode the same latents both ways, so the decode is compared on it's own
+            latents = whole_dist.mean
+            whole = to_unit(vae.decode(latents).sample)
+            tiled = to_unit(tiled_vae_decode(vae, latents))
+
+            # And the tiled encode, decoded whole, so only the encode differs
+            tiled_encoded = to_unit(vae.decode(tiled_dist.mean).sample)
+
+            for stage, images in (("decode", tiled), ("encode", tiled_encoded)):
+                mean_diff, max_diff, psnr, colour = compare(images, whole)
+                print(f"{f'{width}x{height}':>10} {stage:>7} {mean_diff:10.4f} {max_diff:9.4f} {psnr:7.2f} {colour:7.4f}")
+
+            save(whole, f"out/vae_{width}x{height}_whole.png")
+            save(tiled, f"out/vae_{width}x{height}_tiled_decode.png")
+            save(tiled_encoded, f"out/vae_{width}x{height}_tiled_encode.png")
@@ -71,6 +71,10 @@ SAMPLER_CHOICES = []
 for sampler in gdl.SUPPORTED_SAMPLERS_LIST:
     SAMPLER_CHOICES.append(app_commands.Choice(name=sampler, value=sampler))
 
+SIGMA_SCHEDULE_CHOICES = []
+for sigma_schedule in gdl.SUPPORTED_SIGMA_SCHEDULES_LIST:
+    SIGMA_SCHEDULE_CHOICES.append(app_commands.Choice(name=sigma_schedule, value=sigma_schedule))
+
 MODEL_CHOICES = []
 for model in DISCORD_BOT_SETTINGS.model_list:
     MODEL_CHOICES.append(app_commands.Choice(name=model, value=model))
@@ -167,6 +171,7 @@ if __name__ == "__main__":
     prompt='what do you want to create today?',
     model_name='which model to use',
     sampler='which sampling algorithm to use',
+    sigma_schedule='how to space the noise levels (k_* and unipc samplers only)',
     width='width of each output image',
     height='height of each output image',
     scale='conditional guidance scale',
@@ -176,6 +181,7 @@ if __name__ == "__main__":
 )
 @app_commands.choices(
     sampler=SAMPLER_CHOICES,
+    sigma_schedule=SIGMA_SCHEDULE_CHOICES,
     model_name=MODEL_CHOICES,
 )
 async def dream(
@@ -183,6 +189,7 @@ async def dream(
     prompt: str,# = DEFAULT_SAMPLE_SETTINGS.prompt,
     model_name: Optional[app_commands.Choice[str]] = DEFAULT_SAMPLE_SETTINGS.model_name,
     sampler: Optional[app_commands.Choice[str]] = DEFAULT_SAMPLE_SETTINGS.sampler,
+    sigma_schedule: Optional[app_commands.Choice[str]] = DEFAULT_SAMPLE_SETTINGS.sigma_schedule,
     width: Optional[app_commands.Range[int, 64, DEFAULT_SAMPLE_SETTINGS.max_resolution[0]]] = DEFAULT_SAMPLE_SETTINGS.resolution[0],
     height: Optional[app_commands.Range[int, 64, DEFAULT_SAMPLE_SETTINGS.max_resolution[1]]] = DEFAULT_SAMPLE_SETTINGS.resolution[1],
     scale: Optional[app_commands.Range[float, 0.0, 100.0]] = DEFAULT_SAMPLE_SETTINGS.scale,
@@ -207,6 +214,8 @@ async def dream(
     else: args.model_name = model_name.value
     if type(sampler) == str: args.sampler = sampler
     else: args.sampler = sampler.value
+    if type(sigma_schedule) == str: args.sigma_schedule = sigma_schedule
+    else: args.sigma_schedule = sigma_schedule.value
     args.w = width
     args.h = height
     args.scale = scale
@@ -254,6 +263,7 @@ async def dream(
         # don't echo parameters if they have a default value
         if args.model_name == DEFAULT_SAMPLE_SETTINGS.model_name: del args.model_name
         if args.sampler == DEFAULT_SAMPLE_SETTINGS.sampler: del args.sampler
+        if args.sigma_schedule == DEFAULT_SAMPLE_SETTINGS.sigma_schedule: del args.sigma_schedule
         if args.steps == DEFAULT_SAMPLE_SETTINGS.steps: del args.steps
         if args.scale == DEFAULT_SAMPLE_SETTINGS.scale: del args.scale
         if args.n == DEFAULT_SAMPLE_SETTINGS.n: del args.n
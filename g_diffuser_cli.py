@@ -50,6 +50,9 @@ Interactive mode:
 sample("pillars of creation", n=3, scale=15)                         # batch of 3 samples with scale 15
 sample("greg rutkowski", init_img="my_image.png", n=0)               # setting n <=0 repeats until stopped
 sample("something's wrong with the g-diffuser", sampler="k_euler")   # uses the k_euler sampler
+sample("a lighthouse at dusk", sampler="k_dpmpp_2m", steps=16)       # k_dpmpp_2m and unipc need about half the steps
+sample("a lighthouse at dusk", sigma_schedule="karras", steps=20)    # karras / exponential noise spacing for the k_* samplers
+sample("a lighthouse at dusk", scale=[5, 7.5, 10, 12.5])             # guidance scale sweep, all the scales are sampled as one batch
 
 sample() # arguments can be omitted to use your last args instead
 s()      # some commands have shortcuts / aliases
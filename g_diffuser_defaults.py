@@ -3,7 +3,8 @@ import argparse
 # ******************** SETTINGS BEGIN ************************
 
 DEFAULT_SAMPLE_SETTINGS = argparse.Namespace()
-DEFAULT_SAMPLE_SETTINGS.sampler = "k_euler"                  # default sampling mode (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms)
+DEFAULT_SAMPLE_SETTINGS.sampler = "k_euler"                  # default sampling mode (ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_lms, k_dpmpp_2m, unipc)
+DEFAULT_SAMPLE_SETTINGS.sigma_schedule = "default"           # noise level spacing for the k_* and unipc samplers (default, karras, exponential)
 DEFAULT_SAMPLE_SETTINGS.n = 1                                # number of samples to generate per sample command by default
 DEFAULT_SAMPLE_SETTINGS.prompt = "machine shop in year 2100, robotic arms fixing a car, highly ornamented machines, artgem and Swarovski crystals, extreme wide angle, steam clouds, ant view, art by lisa frank"
 DEFAULT_SAMPLE_SETTINGS.resolution = (512,512)               # default resolution for img / video outputs
@@ -13,6 +14,9 @@ DEFAULT_SAMPLE_SETTINGS.noise_start = 0.42                   # default strength
 DEFAULT_SAMPLE_SETTINGS.noise_end = 0.01                     # can be used to influence in/out-painting quality
 DEFAULT_SAMPLE_SETTINGS.noise_eta = 0.70                     # can be used to influence in/out-painting quality
 DEFAULT_SAMPLE_SETTINGS.scale = 10.                           # default cfg scale
+DEFAULT_SAMPLE_SETTINGS.guidance_cutoff = 1.                 # stop cfg guidance after this fraction of the steps (e.g. 0.7) to save time, 1 guides every step
+DEFAULT_SAMPLE_SETTINGS.guidance_cutoff_delta = 0.           # stop cfg guidance once the cond / uncond difference is below this, 0 to disable
+DEFAULT_SAMPLE_SETTINGS.tile_size = 0                        # denoise images larger than this as overlapping tiles of this size (e.g. 512), 0 to disable
 DEFAULT_SAMPLE_SETTINGS.steps = 32                           # default number of sampling steps, lower to reduce sampling time
 DEFAULT_SAMPLE_SETTINGS.noise_q = 1.                         # fall-off of shaped noise distribution for in/out-painting
 DEFAULT_SAMPLE_SETTINGS.auto_seed_range = (10000,99999)      # automatic random seed range